@@ -4,9 +4,13 @@ import logging
 import time
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Dict, Callable, Union, Optional
+from typing import Dict, Callable, Union, Optional, TYPE_CHECKING
 
 from hauptbahnhof.core.config import Config
+from hauptbahnhof.core.dispatch import Dispatcher, POLICY_QUEUE
+
+if TYPE_CHECKING:
+    from hauptbahnhof.host import ModuleHost
 
 import paho.mqtt.client as mqtt
 
@@ -26,19 +30,25 @@ class HauptbahnhofModule:
     Hauptbahnhof manager with a lot of convenience methods
     """
 
-    def __init__(self, name):
+    def __init__(self, name, host: Optional["ModuleHost"] = None):
         self.name = name
-        args = self.create_parser().parse_args()
-
-        self._config_base_dir = args.config_dir
+        if host is None:
+            args = self.create_parser().parse_args()
+            self._config_base_dir = args.config_dir
 
-        # find master config
-        self.config = Config()
-        self._load_config("hauptbahnhof")
+            # find master config
+            self.config = Config()
+            self._load_config("hauptbahnhof")
 
-        self._mqtt = mqtt.Client(client_id=f"hauptbahnhof-{self.name}")
-        self._mqtt.on_message = self._on_message
-        self._mqtt.on_connect = self.on_connect
+            self._mqtt = mqtt.Client(client_id=f"hauptbahnhof-{self.name}")
+            self._mqtt.on_message = self._on_message
+            self._mqtt.on_connect = self.on_connect
+        else:
+            # share the parsed config and the connection of the host, modules may add
+            # their own config files, so every module gets its own copy
+            self._config_base_dir = host.config_dir
+            self.config = Config(host.config)
+            self._mqtt = host.connection(self)
 
         logging.basicConfig(format=LOG_FORMAT)
         self.logger: logging.Logger = logging.getLogger(self.name)
@@ -46,7 +56,14 @@ class HauptbahnhofModule:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
-        self._mqtt.enable_logger(self.logger)
+        if host is None:
+            self._mqtt.enable_logger(self.logger)
+
+        # callbacks run on worker threads, never on the mqtt network thread
+        self._dispatcher = Dispatcher(
+            self.config.get("dispatch_workers", 4), self.logger
+        )
+        self._default_lane = self._dispatcher.lane("#", self._handle_message)
 
     def create_parser(self) -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser(f"Hauptbahnhof {self.name}")
@@ -54,7 +71,19 @@ class HauptbahnhofModule:
 
         return parser
 
+    def start(self):
+        """
+        Start background work of the module, called before it connects
+        """
+
+    def stop(self):
+        """
+        Stop the module, its queued callbacks are dropped
+        """
+        self._dispatcher.shutdown(wait=False)
+
     def run(self):
+        self.start()
         while True:
             try:
                 self._connect()
@@ -81,6 +110,9 @@ class HauptbahnhofModule:
         self.logger.info("Connected to mqqt broker on %s", self.config["mqtt"]["host"])
 
     def _on_message(self, client, userdata, msg):
+        self._dispatcher.submit(self._default_lane, msg)
+
+    def _handle_message(self, msg):
         try:
             self.on_message(msg)
         except Exception as e:
@@ -109,15 +141,40 @@ class HauptbahnhofModule:
 
         raise FileNotFoundError(f"Did not find config file {file_path}")
 
-    def subscribe(self, topic: str, callback: Optional[Callable] = None) -> None:
+    def subscribe(
+        self,
+        topic: str,
+        callback: Optional[Callable] = None,
+        concurrency: int = 1,
+        policy: str = POLICY_QUEUE,
+        max_queue: int = 100,
+    ) -> None:
         """
         Subscribe to topic
+
+        The callback runs on a worker thread, at most concurrency calls at a time. With
+        the "latest" policy a new message replaces the queued ones and marks the running
+        calls as superseded, see hauptbahnhof.core.dispatch.superseded.
         """
         self._mqtt.subscribe(topic)
         if callback:
-            self._mqtt.message_callback_add(topic, callback)
+            lane = self._dispatcher.lane(
+                topic, callback, concurrency, policy, max_queue
+            )
+            self._mqtt.message_callback_add(
+                topic,
+                lambda client, userdata, msg: self._dispatcher.submit(
+                    lane, client, userdata, msg
+                ),
+            )
         self.logger.info("subscribed to topic %s", topic)
 
+    def dispatch_stats(self) -> Dict[str, Dict]:
+        """
+        Queue depth and counters of the callbacks of every subscription
+        """
+        return self._dispatcher.stats()
+
     def publish(self, topic: str, msg: Union[str, int, float, Dict]) -> None:
         """
         Publish a message on the given topic
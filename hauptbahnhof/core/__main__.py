@@ -4,6 +4,7 @@ import logging
 
 from .config import Config
 from .mqtt import MQTT
+from .persistence import StateSnapshotFile
 from .state import State
 from .ws import WebSocket
 
@@ -30,11 +31,28 @@ async def main():
     state = State.from_config(config, logger)
     ws = WebSocket(config, state, logger)
     mqtt = MQTT.from_config(config, state, logger)
+    ws.stats_providers["mqtt"] = mqtt.stats
+
+    tasks = [
+        ws.start_server(),
+        ws.state_handler(),
+        ws.tokens.run(),
+        state.frames.run(),
+        state.history.run(),
+        state.fades.run(),
+        mqtt.run(),
+        mqtt.ingest.run(),
+        mqtt.handle_state_updates(),
+    ]
+
+    # continue with the state from before a restart instead of switching everything off
+    snapshots = StateSnapshotFile.from_config(config, state, logger)
+    if snapshots is not None:
+        snapshots.restore()
+        tasks.append(snapshots.run())
 
     await state.init()
-    await asyncio.gather(
-        ws.start_server(), ws.state_handler(), mqtt.run(), mqtt.handle_state_updates()
-    )
+    await asyncio.gather(*tasks)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import json
+import struct
+from typing import Dict, Iterable, Tuple
+
+# websocket subprotocol a client requests to receive binary state updates
+SUBPROTOCOL = "hauptbahnhof.binary"
+
+FRAME_STATE_UPDATE = 1
+
+_HEADER = struct.Struct("<BI")
+
+
+class TopicDictionary:
+    """
+    Maps every base topic to a numeric id for the binary websocket protocol.
+
+    A binary state update frame is a frame type byte and the uint32 sequence number of
+    the update followed by (uint16 topic id, uint16 value) pairs, all little endian.
+    """
+
+    def __init__(self, topics: Iterable[str]):
+        self.topics = tuple(topics)
+        if len(self.topics) > 0xFFFF:
+            raise ValueError("too many topics for the binary protocol")
+        self.ids: Dict[str, int] = {topic: i for i, topic in enumerate(self.topics)}
+
+        self._encoded = json.dumps({"type": "topic_dictionary", "topics": self.ids})
+
+    def to_json(self) -> str:
+        """
+        The dictionary message sent to binary clients on connect
+        """
+        return self._encoded
+
+    def encode_update(self, nodes: Dict[str, int], seq: int) -> bytes:
+        ids = self.ids
+        pairs = []
+        for topic, value in nodes.items():
+            pairs.append(ids[topic])
+            pairs.append(value)
+        return _HEADER.pack(FRAME_STATE_UPDATE, seq) + struct.pack(
+            f"<{len(pairs)}H", *pairs
+        )
+
+    def decode_update(self, frame: bytes) -> Tuple[int, Dict[str, int]]:
+        """
+        :returns: sequence number and node updates of a binary state update frame
+        """
+        frame_type, seq = _HEADER.unpack_from(frame)
+        if frame_type != FRAME_STATE_UPDATE:
+            raise ValueError(f"unknown binary frame type {frame_type}")
+
+        pairs = struct.unpack_from(
+            f"<{(len(frame) - _HEADER.size) // 2}H", frame, _HEADER.size
+        )
+        nodes = {self.topics[pairs[i]]: pairs[i + 1] for i in range(0, len(pairs), 2)}
+        return seq, nodes
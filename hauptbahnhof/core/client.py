@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, FrozenSet, Optional, Union
+
+import websockets
+from websockets import WebSocketServerProtocol
+
+from . import binary
+
+# placeholder in the send queue for a full state frame rendered at send time
+RESYNC = object()
+
+OVERFLOW_RESYNC = "resync"
+OVERFLOW_DISCONNECT = "disconnect"
+
+
+class Client:
+    """
+    A websocket connection with a bounded outbound queue drained by its own writer task.
+
+    Frames are queued without waiting for the client, a slow client therefore never
+    stalls the others. If the queue overflows the client is either collapsed to a
+    single full state resync or disconnected, depending on the overflow policy. A
+    resync only replaces the queued broadcasts, replies like a new token are always
+    delivered. A client whose queue overflows with replies alone is disconnected.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocketServerProtocol,
+        queue_size: int,
+        overflow_policy: str,
+        resync_frame: Callable[[Optional[FrozenSet[str]]], str],
+        stats: Counter,
+        logger: logging.Logger,
+    ):
+        if overflow_policy not in (OVERFLOW_RESYNC, OVERFLOW_DISCONNECT):
+            raise ValueError(f"unknown slow client policy {overflow_policy}")
+
+        self.websocket = websocket
+        self.logger = logger
+        self.stats = stats
+        # base topics this client is subscribed to, None for all of them
+        self.topics: Optional[FrozenSet[str]] = None
+        # connected to the privileged API
+        self.privileged = False
+        # negotiated binary protocol for state updates instead of json
+        self.binary = websocket.subprotocol == binary.SUBPROTOCOL
+
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._overflow_policy = overflow_policy
+        self._resync_frame = resync_frame
+        self._resync_pending = False
+        self._closing = False
+        self._writer = asyncio.ensure_future(self._write())
+
+    def send(self, frame: Union[str, bytes], broadcast: bool = False) -> None:
+        """
+        Queue a frame for this client without waiting for it to be sent
+
+        :param broadcast: the frame is a state broadcast, which a resync replaces
+        """
+        if self._closing:
+            return
+        try:
+            self._queue.put_nowait((frame, broadcast))
+        except asyncio.QueueFull:
+            self._overflow(frame, broadcast)
+
+    def broadcast(self, frame: Union[str, bytes]) -> None:
+        """
+        Queue a state broadcast, dropped if a pending resync already covers it
+        """
+        if self._resync_pending:
+            self.stats["dropped_broadcasts"] += 1
+            return
+        self.send(frame, broadcast=True)
+
+    def _overflow(self, frame: Union[str, bytes], broadcast: bool):
+        if self._overflow_policy == OVERFLOW_DISCONNECT:
+            self._disconnect()
+            return
+
+        # drop the queued broadcasts, the client gets the complete current state instead
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        kept = [item for item in queued if not item[1]]
+        if not broadcast:
+            kept.append((frame, False))
+        kept.append((RESYNC, True))
+        if len(kept) > self._queue.maxsize:
+            self._disconnect()
+            return
+
+        self.logger.debug("resyncing slow websocket client %s", self.websocket)
+        self.stats["slow_client_resyncs"] += 1
+        for item in kept:
+            self._queue.put_nowait(item)
+        self._resync_pending = True
+
+    def _disconnect(self):
+        self.logger.info("disconnecting slow websocket client %s", self.websocket)
+        self.stats["slow_client_disconnects"] += 1
+        self._closing = True
+        self.stop()
+        asyncio.ensure_future(self.websocket.close(1013, "client too slow"))
+
+    async def _write(self):
+        while True:
+            frame, _ = await self._queue.get()
+            if frame is RESYNC:
+                self._resync_pending = False
+                frame = self._resync_frame(self.topics)
+            try:
+                await self.websocket.send(frame)
+            except websockets.ConnectionClosed:
+                return
+
+    def stop(self):
+        self._writer.cancel()
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from .node import Node
+from .updatequeue import PRIORITY_NORMAL, UpdateQueue
+from .utils import MQTTUpdate
+
+
+class FrameCoalescer:
+    """
+    Rate limit the mqtt frames sent to each node.
+
+    Changed nodes are marked by the state and flushed to the mqtt update queue at most
+    max_frame_rate times per second each. The priority only decides the order in the
+    queue, high priority nodes are rate limited like all others. The queue holds the
+    flushed nodes and the payload is rendered when it is sent, so intermediate states
+    are dropped but the latest state is always delivered.
+
+    Batchable nodes of the same type sharing a topic which are flushed together are
+    merged into a single message.
+    """
+
+    def __init__(
+        self,
+        queue: UpdateQueue,
+        max_frame_rate: Optional[float],
+        logger: logging.Logger,
+    ):
+        self.logger = logger
+        self._queue = queue
+        self._max_frame_rate = max_frame_rate
+
+        # nodes waiting for their next frame with their priority, in marking order
+        self._pending: Dict[Node, int] = {}
+        self._last_flush: Dict[Node, float] = {}
+        self._wakeup = asyncio.Event()
+
+        self.stats = Counter()
+
+    def _min_interval(self, node: Node) -> float:
+        rate = node.max_frame_rate or self._max_frame_rate
+        return 1 / rate if rate else 0
+
+    def mark(self, node: Node, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Schedule a frame with the current state of node
+        """
+        pending = self._pending.get(node)
+        if pending is not None:
+            self.stats["coalesced_frames"] += 1
+            if priority >= pending:
+                return
+
+        self._pending[node] = priority
+        self._wakeup.set()
+
+    @staticmethod
+    def frame_key(node: Node) -> Hashable:
+        """
+        Nodes with the same key are sent in one frame
+        """
+        return (type(node), node.topic) if node.batchable else node
+
+    @staticmethod
+    def render(nodes: Sequence[Node]) -> MQTTUpdate:
+        """
+        The frame with the current state of nodes, which share a topic. It is sent
+        with the highest qos of the nodes and retained if any of them is.
+        """
+        if len(nodes) == 1:
+            payload = nodes[0].state_as_mqtt_message()
+        else:
+            payload = type(nodes[0]).merge_payloads(nodes)
+        return MQTTUpdate(
+            nodes[0].topic,
+            payload,
+            max(node.qos for node in nodes),
+            any(node.retain for node in nodes),
+        )
+
+    @staticmethod
+    def merge(queued: Tuple[Node, ...], nodes: Tuple[Node, ...]) -> Tuple[Node, ...]:
+        """
+        Merge the nodes of a frame still in the queue with a newer one of the same key
+        """
+        return tuple(dict.fromkeys(queued + nodes))
+
+    def flush(self, now: float) -> Optional[float]:
+        """
+        Queue a frame for every pending node whose rate limit allows it.
+
+        :returns: seconds until the next pending node is due, None if nothing is pending
+        """
+        batches: Dict[Hashable, List[Node]] = {}
+        waiting = []
+        for node, priority in self._pending.items():
+            due = self._last_flush.get(node, float("-inf")) + self._min_interval(node)
+            if due > now:
+                waiting.append((node, due))
+                continue
+
+            batches.setdefault(self.frame_key(node), []).append(node)
+
+        next_due = None
+        for node, due in waiting:
+            # ride along with a batch that is sent anyway, keeps batch mates in sync
+            key = self.frame_key(node)
+            if key in batches:
+                batches[key].append(node)
+            elif next_due is None or due < next_due:
+                next_due = due
+
+        for key, nodes in batches.items():
+            priority = PRIORITY_NORMAL
+            for node in nodes:
+                priority = min(priority, self._pending.pop(node))
+                self._last_flush[node] = now
+
+            self._queue.put_nowait(key, tuple(nodes), priority)
+            self.stats["frames"] += 1
+            self.stats["node_frames"] += len(nodes)
+
+        return None if next_due is None else next_due - now
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            self._wakeup.clear()
+            delay = self.flush(loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
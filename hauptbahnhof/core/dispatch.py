@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Tuple
+
+# run every message, queued messages beyond max_queue drop the oldest one
+POLICY_QUEUE = "queue"
+# only the newest message matters, it replaces queued ones and supersedes running ones
+POLICY_LATEST = "latest"
+
+_current = threading.local()
+
+
+def superseded() -> bool:
+    """
+    Whether a newer message arrived for the callback running in this thread, long
+    running callbacks of "latest" subscriptions should check this and stop early
+    """
+    event = getattr(_current, "superseded", None)
+    return event is not None and event.is_set()
+
+
+class Lane:
+    """
+    Messages of one subscription, at most concurrency of them run at the same time
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        callback: Callable,
+        concurrency: int,
+        policy: str,
+        max_queue: int,
+    ):
+        if policy not in (POLICY_QUEUE, POLICY_LATEST):
+            raise ValueError(f"unknown dispatch policy {policy}")
+
+        self.topic = topic
+        self.callback = callback
+        self.concurrency = concurrency
+        self.policy = policy
+        self.max_queue = max_queue
+
+        # (arguments, enqueue time)
+        self.pending: Deque[Tuple[Tuple, float]] = deque()
+        # superseded flags of the running calls
+        self.running: Dict[int, threading.Event] = {}
+
+        self.stats = Counter()
+
+
+class Dispatcher:
+    """
+    Runs subscription callbacks on a bounded thread pool.
+
+    The mqtt network thread only enqueues messages and never waits for module code,
+    so keepalives and other topics are still handled while a callback runs.
+    """
+
+    def __init__(self, workers: int, logger: logging.Logger):
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="dispatch"
+        )
+        self._lock = threading.Lock()
+        self._lanes: Dict[str, Lane] = {}
+        self._call_ids = 0
+
+    def lane(
+        self,
+        topic: str,
+        callback: Callable,
+        concurrency: int = 1,
+        policy: str = POLICY_QUEUE,
+        max_queue: int = 100,
+    ) -> Lane:
+        """
+        Register a subscription, registering it again keeps its queue and metrics
+        """
+        with self._lock:
+            lane = self._lanes.get(topic)
+            if lane is None or lane.callback != callback:
+                lane = Lane(topic, callback, concurrency, policy, max_queue)
+                self._lanes[topic] = lane
+            return lane
+
+    def submit(self, lane: Lane, *args):
+        with self._lock:
+            if lane.policy == POLICY_LATEST:
+                lane.stats["superseded"] += len(lane.pending) + len(lane.running)
+                lane.pending.clear()
+                for event in lane.running.values():
+                    event.set()
+            elif len(lane.pending) >= lane.max_queue:
+                lane.pending.popleft()
+                lane.stats["dropped"] += 1
+
+            lane.pending.append((args, time.monotonic()))
+            lane.stats["max_depth"] = max(lane.stats["max_depth"], len(lane.pending))
+            self._start(lane)
+
+    def _start(self, lane: Lane):
+        # called with the lock held
+        while lane.pending and len(lane.running) < lane.concurrency:
+            args, enqueued = lane.pending.popleft()
+            self._call_ids += 1
+            event = threading.Event()
+            lane.running[self._call_ids] = event
+            lane.stats["wait_ms"] += int((time.monotonic() - enqueued) * 1000)
+            self._executor.submit(self._run, lane, self._call_ids, event, args)
+
+    def _run(self, lane: Lane, call_id: int, event: threading.Event, args: Tuple):
+        _current.superseded = event
+        try:
+            lane.callback(*args)
+        except Exception:
+            lane.stats["errors"] += 1
+            self.logger.exception("callback for topic %s failed", lane.topic)
+        finally:
+            _current.superseded = None
+            with self._lock:
+                del lane.running[call_id]
+                lane.stats["processed"] += 1
+                self._start(lane)
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        :returns: queue depth, running calls and counters of every subscription
+        """
+        with self._lock:
+            return {
+                topic: {
+                    "depth": len(lane.pending),
+                    "running": len(lane.running),
+                    **lane.stats,
+                }
+                for topic, lane in self._lanes.items()
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, Dict, Iterable, Optional
+
+from .updatequeue import PRIORITY_HIGH, PRIORITY_NORMAL
+
+# easing curves map the elapsed fraction of a fade to the fraction of the value change
+EASINGS: Dict[str, Callable[[float], float]] = {
+    "linear": lambda t: t,
+    "ease-in": lambda t: t * t,
+    "ease-out": lambda t: 1 - (1 - t) * (1 - t),
+    "ease-in-out": lambda t: t * t * (3 - 2 * t),
+}
+
+
+class Fade:
+    __slots__ = ("start_value", "target", "start", "duration", "easing", "priority")
+
+    def __init__(
+        self,
+        start_value: int,
+        target: int,
+        start: float,
+        duration: float,
+        easing: Callable[[float], float],
+        priority: int = PRIORITY_NORMAL,
+    ):
+        self.start_value = start_value
+        self.target = target
+        self.start = start
+        self.duration = duration
+        self.easing = easing
+        self.priority = priority
+
+    def value_at(self, now: float) -> int:
+        progress = min((now - self.start) / self.duration, 1.0)
+        return round(
+            self.start_value + (self.target - self.start_value) * self.easing(progress)
+        )
+
+
+class FadeEngine:
+    """
+    Interpolates base topics towards target values.
+
+    All active fades are advanced together at a fixed tick rate and written as a single
+    batch per priority, the frame coalescer turns every tick into at most one frame per
+    node. A new fade or a direct write to a topic replaces its running fade.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[Dict[str, int], bool, int], None],
+        read: Callable[[str], int],
+        logger: logging.Logger,
+        tick_rate: float = 50,
+    ):
+        self.logger = logger
+        self._apply = apply
+        self._read = read
+        self._interval = 1 / tick_rate
+
+        self._fades: Dict[str, Fade] = {}
+        self._wakeup = asyncio.Event()
+
+        self.stats = Counter()
+
+    def __len__(self) -> int:
+        return len(self._fades)
+
+    def start(
+        self,
+        values: Dict[str, int],
+        duration: float,
+        easing: str = "linear",
+        now: Optional[float] = None,
+        priority: int = PRIORITY_NORMAL,
+        force: bool = False,
+    ):
+        """
+        Fade base topics from their current to the given values
+
+        :param duration: fade time in seconds, values are set immediately if it is 0
+        :param priority: priority of every step of the fade
+        :param force: write the values even if unchanged, only for a duration of 0
+        """
+        if duration <= 0:
+            self.cancel(values)
+            self._apply(values, force, priority)
+            return
+
+        if now is None:
+            now = asyncio.get_event_loop().time()
+        curve = EASINGS[easing]
+        fades = self._fades
+        for topic, target in values.items():
+            if topic in fades:
+                self.stats["replaced_fades"] += 1
+            fades[topic] = Fade(
+                self._read(topic), target, now, duration, curve, priority
+            )
+        self.stats["fades"] += len(values)
+        self._wakeup.set()
+
+    def cancel(self, topics: Iterable[str]):
+        fades = self._fades
+        if not fades:
+            return
+        for topic in topics:
+            if fades.pop(topic, None) is not None:
+                self.stats["cancelled_fades"] += 1
+
+    def tick(self, now: float):
+        """
+        Write the current value of all active fades and drop the finished ones
+        """
+        values: Dict[int, Dict[str, int]] = {PRIORITY_HIGH: {}, PRIORITY_NORMAL: {}}
+        finished = []
+        for topic, fade in self._fades.items():
+            values[fade.priority][topic] = fade.value_at(now)
+            if now >= fade.start + fade.duration:
+                finished.append(topic)
+        for topic in finished:
+            del self._fades[topic]
+
+        self.stats["ticks"] += 1
+        for priority, batch in values.items():
+            if batch:
+                self._apply(batch, False, priority)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        next_tick = loop.time()
+        while True:
+            if not self._fades:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                next_tick = loop.time()
+
+            self.tick(loop.time())
+            # schedule against the ideal tick times so the fade speed does not drift
+            next_tick += self._interval
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
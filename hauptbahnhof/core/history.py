@@ -0,0 +1,239 @@
+import asyncio
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .utils import StateUpdate
+
+# bytes of one sample, an int64 timestamp and a uint16 value
+_SAMPLE_SIZE = array("q").itemsize + array("H").itemsize
+
+
+class Series:
+    """
+    Value changes of a single topic.
+
+    Timestamps are milliseconds and never decrease, so the samples of a time range are
+    found by bisection. Once the capacity is reached the older half of the series is
+    downsampled by dropping every second sample, so old data gets coarser while recent
+    data stays exact.
+    """
+
+    __slots__ = ("capacity", "timestamps", "values")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array("q")
+        self.values = array("H")
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def append(self, timestamp: int, value: int):
+        if self.values:
+            if len(self.values) >= self.capacity:
+                self._downsample()
+            # a clock step back must not break the order
+            timestamp = max(timestamp, self.timestamps[-1])
+
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def _downsample(self):
+        half = len(self.values) // 2 & ~1
+        # keep the later sample of each pair, it is the value that held afterwards
+        self.timestamps = self.timestamps[1:half:2] + self.timestamps[half:]
+        self.values = self.values[1:half:2] + self.values[half:]
+
+    def range(self, start: int, end: int) -> Tuple[int, int]:
+        """
+        :returns: index range of the samples between start and end, including the
+                  sample that was current at start
+        """
+        timestamps = self.timestamps
+        current = bisect_left(timestamps, start)
+        return max(current - 1, 0), bisect_right(timestamps, end, current)
+
+    def copy(self, start: int, end: int) -> "Series":
+        """
+        :returns: a copy of the samples a query between start and end reads
+        """
+        first, last = self.range(start, end)
+        part = Series(self.capacity)
+        part.timestamps = self.timestamps[first:last]
+        part.values = self.values[first:last]
+        return part
+
+    def query(
+        self, start: int, end: int, limit: Optional[int] = None
+    ) -> List[Tuple[int, int]]:
+        """
+        :returns: all samples between start and end, preceded by the sample that was
+                  current at start, only the last limit samples if given
+        """
+        first, last = self.range(start, end)
+        if limit is not None:
+            first = max(first, last - limit)
+        return list(zip(self.timestamps[first:last], self.values[first:last]))
+
+    def aggregate(
+        self, start: int, end: int, bucket: int, limit: Optional[int] = None
+    ) -> List:
+        """
+        :returns: [bucket start, min, max, mean, last] of every bucket with samples,
+                  only the last limit buckets if given
+        """
+        timestamps, values = self.timestamps, self.values
+        first, last = self.range(start, end)
+        buckets = []
+        # from the end, each bucket is found by bisection and reduced on array slices
+        while last > first and (limit is None or len(buckets) < limit):
+            # the sample current at start counts for the first bucket
+            index = max(timestamps[last - 1] - start, 0) // bucket
+            if index == 0:
+                lower = first
+            else:
+                lower = bisect_left(timestamps, start + index * bucket, first, last)
+            chunk = values[lower:last]
+            buckets.append(
+                [
+                    start + index * bucket,
+                    min(chunk),
+                    max(chunk),
+                    sum(chunk) / len(chunk),
+                    chunk[-1],
+                ]
+            )
+            last = lower
+        buckets.reverse()
+        return buckets
+
+
+class History:
+    """
+    In-memory history of the values of all base topics.
+
+    Recording only queues the update batches of process_updates, they are added to
+    the per topic arrays by a background task and before every query. The memory is capped
+    by limiting the number of samples per topic, which downsamples the oldest data.
+    Without downsampling a topic keeps max_samples value changes.
+    """
+
+    def __init__(
+        self,
+        topics: Iterable[str],
+        max_memory: int = 16 * 1024 * 1024,
+        max_samples: int = 16384,
+        flush_interval: float = 1.0,
+        max_points: int = 2000,
+    ):
+        topics = tuple(topics)
+        # the per topic limit also bounds the time a single downsampling takes
+        capacity = max_memory // (_SAMPLE_SIZE * max(len(topics), 1))
+        capacity = max(64, min(capacity, max_samples))
+        self._series: Dict[str, Series] = {topic: Series(capacity) for topic in topics}
+
+        self.flush_interval = flush_interval
+        # bounds the time a query blocks the event loop and the size of its reply
+        self.max_points = max_points
+        self._pending: List[Tuple[int, List[StateUpdate]]] = []
+
+        self.stats = Counter()
+
+    def record(self, updates: List[StateUpdate], timestamp: Optional[int] = None):
+        """
+        Queue a batch of updates, they are added to the series by the next flush
+        """
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        self._pending.append((timestamp, updates))
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        series = self._series
+        samples = 0
+        for timestamp, updates in pending:
+            for update in updates:
+                series[update.topic].append(timestamp, update.value)
+            samples += len(updates)
+        self.stats["samples"] += samples
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def memory(self) -> int:
+        """
+        :returns: bytes used by the recorded samples
+        """
+        return sum(len(series) for series in self._series.values()) * _SAMPLE_SIZE
+
+    def query(
+        self,
+        topics: Iterable[str],
+        start: int,
+        end: int,
+        bucket: Optional[int] = None,
+    ) -> Dict[str, Dict]:
+        """
+        Samples or aggregates of the given topics between start and end, all times in
+        milliseconds since the epoch.
+
+        Without a bucket size the samples are returned as [timestamp, value] pairs, the
+        first one being the value current at start. With a bucket size every bucket
+        with samples is aggregated to [bucket start, min, max, mean, last]. At most
+        max_points samples or buckets are returned per topic, the most recent ones.
+        """
+        return self._summarize(self._copy(topics, start, end), start, end, bucket)
+
+    async def query_async(
+        self,
+        topics: Iterable[str],
+        start: int,
+        end: int,
+        bucket: Optional[int] = None,
+    ) -> Dict[str, Dict]:
+        """
+        Like query, the aggregation runs in an executor on a copy of the samples so a
+        large query does not block the event loop
+        """
+        series = self._copy(topics, start, end)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self._summarize, series, start, end, bucket
+        )
+
+    def _copy(self, topics: Iterable[str], start: int, end: int) -> Dict[str, Series]:
+        self.flush()
+        return {
+            topic: self._series[topic].copy(start, end)
+            for topic in topics
+            if topic in self._series
+        }
+
+    def _summarize(
+        self, series: Dict[str, Series], start: int, end: int, bucket: Optional[int]
+    ) -> Dict[str, Dict]:
+        limit = self.max_points
+        result = {}
+        for topic, samples in series.items():
+            first, last = samples.range(start, end)
+
+            entry = {}
+            if last > first:
+                values = samples.values[first:last]
+                entry.update(min=min(values), max=max(values), last=values[-1])
+            if bucket is None:
+                entry["samples"] = samples.query(start, end, limit)
+                truncated = last - first > limit
+            else:
+                entry["buckets"] = samples.aggregate(start, end, bucket, limit + 1)
+                truncated = len(entry["buckets"]) > limit
+                if truncated:
+                    del entry["buckets"][0]
+            if truncated:
+                entry["truncated"] = True
+            result[topic] = entry
+        return result
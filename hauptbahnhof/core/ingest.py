@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .state import State
+from .updatequeue import PRIORITY_HIGH, PRIORITY_NORMAL
+
+# applies the scene given in {"scene": "<name>"}
+SCENE_TOPIC = "/haspa/scene"
+# sets several topics at once, same format as the updates of a websocket state_update
+STATE_SET_TOPIC = "/haspa/state/set"
+
+# (topic, raw payload) as received from the broker
+Message = Tuple[str, bytes]
+
+
+class MessageBatcher:
+    """
+    Applies received mqtt messages to the state in batches.
+
+    Everything already received, up to max_batch messages, is applied with a single
+    process_updates call, so a burst of messages results in one state pass, one
+    websocket delta and one frame per node. Within a batch the last value of a topic
+    wins. Fades, scenes and priority changes split a batch to keep the message order.
+    Bulk messages on STATE_SET_TOPIC join the batch like their single topic messages,
+    they have high priority if any of their topics is a priority topic.
+    Messages on topics the state does not handle, e.g. those the core receives through
+    its wildcard subscriptions, are dropped. A message which fails to apply is logged
+    and skipped, the rest of the batch is applied.
+    """
+
+    def __init__(
+        self,
+        state: State,
+        logger: logging.Logger,
+        priority_topics: Iterable[str] = (),
+        max_batch: int = 500,
+        window: float = 0.005,
+    ):
+        self.state = state
+        self.logger = logger
+        # updates on these topics overtake queued effect and fade traffic
+        self.priority_topics = frozenset(priority_topics)
+        self.max_batch = max_batch
+        self.window = window
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+        self.stats = Counter()
+
+    def put_nowait(self, topic: str, payload: bytes):
+        self._queue.put_nowait((topic, payload))
+
+    async def _next_batch(self) -> List[Message]:
+        batch = [await self._queue.get()]
+        # give a burst the time to arrive, high priority messages are applied right away
+        if self.window > 0 and not self._is_priority(*batch[0]):
+            await asyncio.sleep(self.window)
+        queue = self._queue
+        while len(batch) < self.max_batch and not queue.empty():
+            batch.append(queue.get_nowait())
+        return batch
+
+    def _is_priority(self, topic: str, payload: bytes) -> bool:
+        """
+        Whether the message is on a priority topic or a bulk update setting one
+        """
+        if topic in self.priority_topics:
+            return True
+        if topic != STATE_SET_TOPIC or not self.priority_topics:
+            return False
+        try:
+            nodes = json.loads(payload).get("nodes")
+        except (ValueError, AttributeError):
+            return False
+        return isinstance(nodes, dict) and not self.priority_topics.isdisjoint(nodes)
+
+    async def run(self):
+        while True:
+            self.handle_messages(await self._next_batch())
+
+    def handle_messages(self, messages: Sequence[Message]):
+        nodes: Dict[str, int] = {}
+        # priority and fade shared by all messages in nodes
+        current: Optional[Tuple[int, Optional[Dict]]] = None
+        for topic, payload in messages:
+            try:
+                priority = (
+                    PRIORITY_HIGH if topic in self.priority_topics else PRIORITY_NORMAL
+                )
+                if topic == SCENE_TOPIC:
+                    self._apply(nodes, current)
+                    nodes, current = {}, None
+                    self.handle_scene(payload, priority)
+                    continue
+
+                if topic == STATE_SET_TOPIC:
+                    updates = self._parse_bulk(payload)
+                    if updates is None:
+                        continue
+                    # e.g. the alarm sent by a hackerman effect
+                    if not self.priority_topics.isdisjoint(updates["nodes"]):
+                        priority = PRIORITY_HIGH
+                    if updates.get("force"):
+                        # forced writes are not collapsed with anything else
+                        self._apply(nodes, current)
+                        nodes, current = {}, None
+                        self.state.process_updates(updates, priority)
+                        self.stats["state_updates"] += 1
+                        continue
+                    values = updates["nodes"].items()
+                    fade = updates.get("fade")
+                elif not self.state.handles(topic):
+                    self.stats["ignored_messages"] += 1
+                    continue
+                else:
+                    parsed = self._parse(topic, payload)
+                    if parsed is None:
+                        continue
+                    value, fade = parsed
+                    values = ((topic, value),)
+
+                if (priority, fade) != current:
+                    self._apply(nodes, current)
+                    nodes, current = {}, (priority, fade)
+                for node_topic, value in values:
+                    # reinserted at the end, so a later group write is not undone by an
+                    # earlier write of one of its members
+                    if nodes.pop(node_topic, None) is not None:
+                        self.stats["collapsed_messages"] += 1
+                    nodes[node_topic] = value
+            except Exception:
+                # a single bad message must not stop the ingest
+                self.logger.exception(
+                    "Failed to handle mqtt message on topic %s: %s", topic, payload
+                )
+                self.stats["failed_messages"] += 1
+
+        self._apply(nodes, current)
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(messages)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(messages))
+
+    def _apply(self, nodes: Dict[str, int], current: Optional[Tuple[int, Dict]]):
+        if not nodes:
+            return
+        priority, fade = current
+        try:
+            self.state.process_updates({"nodes": nodes, "fade": fade}, priority)
+        except Exception:
+            self.logger.exception("Failed to apply mqtt updates: %s", nodes)
+            self.stats["failed_messages"] += len(nodes)
+            return
+        self.stats["state_updates"] += 1
+
+    def _parse(self, topic: str, payload: bytes) -> Optional[Tuple[int, Dict]]:
+        """
+        :returns: value and fade of a plain value or a
+            {"value": ..., "duration": <ms>, "easing": ...} fade payload
+        """
+        try:
+            text = payload.decode()
+            if text.isnumeric():
+                return int(text), None
+            fade = json.loads(text)
+            value = fade.pop("value")
+        except (ValueError, AttributeError, TypeError, KeyError):
+            self.logger.warning(
+                "Received invalid mqtt payload on topic %s: %s", topic, payload
+            )
+            return None
+        return value, fade
+
+    def _parse_bulk(self, payload: bytes) -> Optional[Dict]:
+        """
+        :returns: the validated {"nodes": {...}, "fade": {...}, "force": ...} updates
+        """
+        try:
+            updates = json.loads(payload)
+            valid = isinstance(updates, dict) and isinstance(updates.get("nodes"), dict)
+            valid = valid and isinstance(updates.get("fade", {}), dict)
+        except ValueError:
+            valid = False
+        if not valid:
+            self.logger.warning("Received invalid bulk update: %s", payload)
+            return None
+        return updates
+
+    def handle_scene(self, payload: bytes, priority: int = PRIORITY_NORMAL):
+        try:
+            name = json.loads(payload)["scene"]
+        except (ValueError, TypeError, KeyError):
+            self.logger.warning("Received invalid scene message: %s", payload)
+            return
+
+        self.state.apply_scene(name, priority)
@@ -1,77 +1,152 @@
 import asyncio
 import logging
-from typing import List
+from typing import Dict, Iterable, List
 
 from hbmqtt.client import MQTTClient, ClientException
 from hbmqtt.mqtt.constants import QOS_0
 
 from .config import Config
+from .ingest import MessageBatcher, SCENE_TOPIC, STATE_SET_TOPIC
+from .publisher import Publisher
 from .state import State
-from .utils import MQTTUpdate
+from .topictrie import covering_filters
 
 
 class MQTT:
     def __init__(
-        self, mqtt_host: str, topics: List[str], state: State, logger: logging.Logger
+        self,
+        mqtt_host: str,
+        topics: List[str],
+        state: State,
+        logger: logging.Logger,
+        priority_topics: Iterable[str] = (),
+        batch_size: int = 500,
+        batch_window: float = 0.005,
+        publish_window: int = 16,
+        publish_retries: int = 3,
+        ack_timeout: float = 5.0,
     ):
         self.logger = logger
         self.host = mqtt_host
         self.state = state
 
         self.topics = topics
+        self.ingest = MessageBatcher(
+            state, logger, priority_topics, batch_size, batch_window
+        )
+
+        self.publisher = Publisher(
+            state.mqtt_update_queue,
+            self._publish,
+            logger,
+            window=publish_window,
+            retries=publish_retries,
+            ack_timeout=ack_timeout,
+            mark=state.frames.mark,
+        )
 
-        self._mqtt = MQTTClient()
+        # reconnects are handled by run, which resends the whole state afterwards
+        self._mqtt = MQTTClient(config={"auto_reconnect": False})
 
     async def _connect(self):
         await self._mqtt.connect(self.host)
         self.logger.info("Connected to broker %s", self.host)
 
-    async def handle_message(self, msg):
-        self.logger.debug("Received mqtt message on topic %s: %s", msg.topic, msg.data)
-        payload = msg.data.decode()
-        if not payload.isnumeric():
-            self.logger.warning(
-                "Received invalid mqtt payload on topic %s: %s", msg.topic, msg.data
-            )
-            return
-
-        await self.state.process_updates({"nodes": {msg.topic: int(msg.data)}})
-
     async def run(self):
+        reconnect = False
         while True:
             try:
                 await self._connect()
                 await self._mqtt.subscribe([(topic, QOS_0) for topic in self.topics])
                 self.logger.debug("subscribed on topics: %s", self.topics)
+                if reconnect:
+                    # frames may have been lost while the connection was down
+                    await self.state.init()
+                reconnect = True
                 while True:
                     msg = await self._mqtt.deliver_message()
-                    await self.handle_message(msg)
+                    self.logger.debug(
+                        "Received mqtt message on topic %s: %s", msg.topic, msg.data
+                    )
+                    self.ingest.put_nowait(msg.topic, msg.data)
             except ClientException as e:
                 self.logger.error("Failed when trying to connect to mqtt server: %s", e)
                 await asyncio.sleep(10)
 
+    async def _publish(self, topic: str, payload: bytes, qos: int, retain: bool):
+        publish = asyncio.ensure_future(
+            self._mqtt.publish(topic, payload, qos=qos, retain=retain)
+        )
+        try:
+            await asyncio.wait({publish})
+        except asyncio.CancelledError:
+            # timed out, the publisher retries with the current state
+            publish.cancel()
+            self._forget(payload)
+            raise
+
+        if publish.cancelled() or publish.exception() is not None:
+            self._forget(payload)
+        if publish.cancelled():
+            # hbmqtt cancels the acknowledgement waiters when the connection is lost
+            raise ClientException(f"connection lost while publishing on {topic}")
+        publish.result()
+        self.logger.debug(
+            "published mqtt message on topic %s with payload %s", topic, payload
+        )
+
+    def _forget(self, payload: bytes):
+        """
+        Remove an unacknowledged publish from the hbmqtt session, which would otherwise
+        send it again after a reconnect, after newer frames on the same topic. Relies on
+        the session internals of hbmqtt 0.9.6, which is pinned for this.
+        """
+        session = self._mqtt.session
+        if session is None:
+            return
+        handler = self._mqtt._handler
+        for packet_id, message in list(session.inflight_out.items()):
+            if message.data is payload:
+                del session.inflight_out[packet_id]
+                for waiters in (
+                    handler._puback_waiters,
+                    handler._pubrec_waiters,
+                    handler._pubcomp_waiters,
+                ):
+                    waiters.pop(packet_id, None)
+
     async def handle_state_updates(self):
-        while True:
-            msg: MQTTUpdate = await self.state.mqtt_update_queue.get()
-            await self._mqtt.publish(msg.topic, str(msg.payload).encode())
-            self.logger.debug(
-                "published mqtt message on topic %s with payload %s",
-                msg.topic,
-                msg.payload,
-            )
+        await self.publisher.run()
+
+    def stats(self) -> Dict:
+        return {"ingest": self.ingest.stats, "publish": self.publisher.to_dict()}
 
     @classmethod
     def from_config(cls, config: Config, state: State, logger: logging.Logger):
-        host = config.get("mqtt", {}).get("host")
-        port = config.get("mqtt", {}).get("port")
+        mqtt_config = config.get("mqtt", {})
+        host = mqtt_config.get("host")
+        port = mqtt_config.get("port")
         if not host or not port:
             raise ValueError(f"missing host config for mqtt")
 
+        # a few wildcard subscriptions instead of one per topic, the core drops the
+        # messages it does not handle itself. They leave out the node topics, the
+        # core would otherwise receive every frame it publishes.
+        topics = mqtt_config.get("subscriptions") or covering_filters(
+            state.get_mqtt_topics() + [SCENE_TOPIC, STATE_SET_TOPIC],
+            exclude={node.topic for node in state.nodes},
+        )
         mqtt = MQTT(
             mqtt_host=f"mqtt://{host}:{port}",
-            topics=state.get_mqtt_topics(),
+            topics=topics,
             state=state,
             logger=logger,
+            priority_topics=mqtt_config.get("priority_topics", []),
+            batch_size=mqtt_config.get("batch_size", 500),
+            batch_window=mqtt_config.get("batch_window", 5) / 1000,
+            publish_window=mqtt_config.get("publish_window", 16),
+            publish_retries=mqtt_config.get("publish_retries", 3),
+            ack_timeout=mqtt_config.get("ack_timeout", 5000) / 1000,
         )
 
         return mqtt
@@ -1,74 +1,181 @@
 import json
 import logging
-from typing import Dict, List
+import sys
+from typing import Dict, List, Optional
 
 from hauptbahnhof.core.config import Config
+from hauptbahnhof.core.store import ChannelStore
 
 
 class Node:
-    def __init__(self, topic: str, mappings: Dict[str, int]):
-        self.topic = topic
+    """
+    A device controlled by the core. The channel values live in a ChannelStore, the node
+    is a view of its channels starting at an offset into the store.
+    """
+
+    __slots__ = (
+        "topic",
+        "mappings",
+        "max_frame_rate",
+        "qos",
+        "retain",
+        "_store",
+        "_offset",
+    )
+
+    # number of channels of this node type
+    channels = 1
+    # nodes of the same type publishing on the same topic can share one mqtt message
+    batchable = False
+
+    def __init__(
+        self,
+        topic: str,
+        mappings: Dict[str, int],
+        max_frame_rate: Optional[float] = None,
+        qos: int = 0,
+        retain: bool = False,
+    ):
+        self.topic = sys.intern(topic)
         # maps a base topic like /haspa/licht/1/c to an index of this esp
-        self.mappings = mappings
+        self.mappings = {sys.intern(t): index for t, index in mappings.items()}
+        for mapping, index in self.mappings.items():
+            if not 0 <= index < self.channels:
+                raise ValueError(
+                    f"mapping {mapping} index {index} out of bounds for node {self.topic} "
+                    f"with {self.channels} channels"
+                )
+        # overrides the global mqtt max_frame_rate for this node
+        self.max_frame_rate = max_frame_rate
+        # delivery guarantee and retain flag of the frames sent to this node
+        if qos not in (0, 1, 2):
+            raise ValueError(f"invalid qos {qos} for node {self.topic}")
+        self.qos = qos
+        self.retain = retain
+
+        # until bound to a shared store the node keeps its own
+        self._store = ChannelStore(self.channels)
+        self._offset = 0
+
+    def bind(self, store: ChannelStore, offset: int) -> None:
+        """
+        Move the channels of this node into the given store at offset
+        """
+        store.values[offset : offset + self.channels] = self._store.values[
+            self._offset : self._offset + self.channels
+        ]
+        self._store = store
+        self._offset = offset
 
-        self._state = [0]
+    @property
+    def offset(self) -> int:
+        return self._offset
 
     @property
-    def state(self):
-        return self._state
+    def state(self) -> List[int]:
+        return self._store.values[self._offset : self._offset + self.channels].tolist()
 
     def state_as_mqtt_message(self) -> str:
         raise NotImplementedError()
 
-    def set_state_for_topic(self, topic: str, value: int) -> bool:
+    @classmethod
+    def merge_payloads(cls, nodes: List["Node"]) -> str:
+        """
+        Combine the state of several batchable nodes on the same topic into one message
+        """
+        raise NotImplementedError()
+
+    def set_state_for_topic(self, topic: str, value: int, force: bool = False) -> bool:
         """
         Set the internal state for the given mapping topic.
-        Will return false if the mapping topic is not known, true if the update was successful.
+        Will return false if the mapping topic is not known or the value did not change,
+        true if the update was successful.
         """
         if topic not in self.mappings:
             return False
 
-        self._state[self.mappings[topic]] = value
+        return self.set_channel(self.mappings[topic], value, force)
+
+    def set_channel(self, index: int, value: int, force: bool = False) -> bool:
+        """
+        Set the internal state of the channel with the given index.
+        Will return false if the value did not change, unless forced.
+        """
+        values = self._store.values
+        if values[self._offset + index] == value and not force:
+            return False
+
+        values[self._offset + index] = value
         return True
 
     def state_for_topic(self, topic: str) -> int:
         if topic not in self.mappings:
             raise KeyError(f"topic {topic} not present in Node mapping")
 
-        if self.mappings[topic] > len(self._state):
-            raise IndexError(
-                f"topic mapping index {self.mappings[topic]} out of bounds for state of len {len(self._state)}"
-            )
-
-        return self._state[self.mappings[topic]]
+        return self._store.values[self._offset + self.mappings[topic]]
 
     def to_dict(self):
-        return {mapping: self._state[index] for mapping, index in self.mappings.items()}
+        values = self._store.values
+        return {
+            mapping: values[self._offset + index]
+            for mapping, index in self.mappings.items()
+        }
 
     @classmethod
     def from_dict(cls, dct: Dict):
-        return cls(topic=dct["topic"], mappings=dct["mappings"])
+        return cls(
+            topic=dct["topic"],
+            mappings=dct["mappings"],
+            max_frame_rate=dct.get("max_frame_rate"),
+            qos=dct.get("qos", 0),
+            retain=dct.get("retain", False),
+        )
 
 
 class DFNode(Node):
-    def __init__(self, espid: str, topic: str, mappings: Dict[str, int]):
-        super().__init__(topic, mappings)
+    __slots__ = ("espid",)
+
+    channels = 8
+    batchable = True
+
+    def __init__(
+        self,
+        espid: str,
+        topic: str,
+        mappings: Dict[str, int],
+        max_frame_rate: Optional[float] = None,
+        qos: int = 0,
+        retain: bool = False,
+    ):
+        super().__init__(topic, mappings, max_frame_rate, qos, retain)
         self.espid = espid
 
-        self._state = [0] * 8
-
     def state_as_mqtt_message(self) -> str:
-        payload = {self.espid: self._state}
+        payload = {self.espid: self.state}
+        return json.dumps(payload)
+
+    @classmethod
+    def merge_payloads(cls, nodes: List["DFNode"]) -> str:
+        payload = {node.espid: node.state for node in nodes}
         return json.dumps(payload)
 
     @classmethod
     def from_dict(cls, dct: Dict):
-        return cls(topic=dct["topic"], espid=dct["espid"], mappings=dct["mappings"])
+        return cls(
+            topic=dct["topic"],
+            espid=dct["espid"],
+            mappings=dct["mappings"],
+            max_frame_rate=dct.get("max_frame_rate"),
+            qos=dct.get("qos", 0),
+            retain=dct.get("retain", False),
+        )
 
 
 class DELock(Node):
+    __slots__ = ()
+
     def state_as_mqtt_message(self) -> str:
-        return "OFF" if self._state[0] == 0 else "ON"
+        return "OFF" if self._store.values[self._offset] == 0 else "ON"
 
 
 def create_nodes_from_config(config: Config, logger: logging.Logger) -> List[Node]:
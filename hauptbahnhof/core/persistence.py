@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from .config import Config
+from .state import State
+
+# magic, layout checksum, sequence number, payload length, payload checksum
+_HEADER = struct.Struct("<4sIQII")
+_MAGIC = b"HBST"
+
+
+class StateSnapshotFile:
+    """
+    Persist the channel store so a restarted core continues with the previous state.
+
+    The file holds two fixed size slots which are written alternately, each with a
+    sequence number and checksum. A write torn by a crash therefore only ever destroys
+    the older slot, on startup the newest intact slot is restored. Snapshots are
+    written at most every interval seconds and only if the state changed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        state: State,
+        logger: logging.Logger,
+        interval: float = 1.0,
+    ):
+        self.logger = logger
+        self.path = path
+        self.state = state
+        self.interval = interval
+
+        self._layout = zlib.crc32(state.layout().encode())
+        self._slot_size = _HEADER.size + len(state.store.snapshot())
+        self._seq = 0
+        self._written_version = -1
+        self._last_snapshot = state.store.snapshot()
+
+        self.stats = Counter()
+
+    def _read_slot(self, f, slot: int) -> Optional[tuple]:
+        f.seek(slot * self._slot_size)
+        data = f.read(self._slot_size)
+        if len(data) < self._slot_size:
+            return None
+
+        magic, layout, seq, length, checksum = _HEADER.unpack_from(data)
+        payload = data[_HEADER.size : _HEADER.size + length]
+        if (
+            magic != _MAGIC
+            or layout != self._layout
+            or length != len(payload)
+            or zlib.crc32(payload) != checksum
+        ):
+            return None
+        return seq, payload
+
+    def restore(self) -> bool:
+        """
+        Load the newest intact snapshot into the state
+
+        :returns: whether a snapshot was restored
+        """
+        start = time.perf_counter()
+        try:
+            with self.path.open("rb") as f:
+                slots = [s for s in (self._read_slot(f, 0), self._read_slot(f, 1)) if s]
+        except FileNotFoundError:
+            self.logger.info("no state snapshot found at %s", self.path)
+            return False
+        except OSError as e:
+            self.logger.error("could not read state snapshot %s: %s", self.path, e)
+            return False
+
+        if not slots:
+            self.logger.warning(
+                "no usable state snapshot in %s, the node config may have changed",
+                self.path,
+            )
+            return False
+
+        self._seq, payload = max(slots)
+        self.state.restore(payload)
+        self._written_version = self.state.version
+        self._last_snapshot = payload
+        self.logger.info(
+            "restored state snapshot %d from %s in %.2f ms",
+            self._seq,
+            self.path,
+            (time.perf_counter() - start) * 1000,
+        )
+        return True
+
+    def _write(self, seq: int, payload: bytes):
+        header = _HEADER.pack(
+            _MAGIC, self._layout, seq, len(payload), zlib.crc32(payload)
+        )
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, header + payload, (seq % 2) * self._slot_size)
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+    async def write(self):
+        """
+        Write the current state into the older slot
+        """
+        version = self.state.version
+        payload = self.state.store.snapshot()
+        changed = len(self.state.store.diff(self._last_snapshot))
+        seq = self._seq + 1
+
+        # keep the disk write and fsync off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, self._write, seq, payload)
+        # only a successful write counts, a failed one is retried into the same slot
+        # so the other slot keeps the last good snapshot
+        self._written_version = version
+        self._last_snapshot = payload
+        self._seq = seq
+        self.stats["writes"] += 1
+        self.stats["bytes_written"] += _HEADER.size + len(payload)
+        self.stats["changed_channels"] += changed
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.state.version == self._written_version:
+                continue
+            try:
+                await self.write()
+            except OSError as e:
+                self.logger.error("could not write state snapshot %s: %s", self.path, e)
+
+    @classmethod
+    def from_config(
+        cls, config: Config, state: State, logger: logging.Logger
+    ) -> Optional["StateSnapshotFile"]:
+        state_config = config.get("state", {})
+        if not state_config.get("snapshot_file"):
+            return None
+
+        return cls(
+            path=Path(state_config["snapshot_file"]),
+            state=state,
+            logger=logger,
+            interval=state_config.get("snapshot_interval", 1.0),
+        )
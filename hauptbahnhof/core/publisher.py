@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from .coalesce import FrameCoalescer
+from .node import Node
+from .updatequeue import UpdateQueue
+
+Frame = Tuple[Node, ...]
+
+
+class Publisher:
+    """
+    Sends the frames of the mqtt update queue with up to window publishes in flight.
+
+    Frames on the same topic are never in flight at the same time, so every topic
+    receives its frames in order. A frame which is queued while one on its topic is in
+    flight waits for it, further frames for the same nodes are merged into it.
+
+    Frames with qos 1 or 2 which are not acknowledged within ack_timeout are retried.
+    Every attempt renders the current state of the nodes and takes a waiting frame
+    for the same nodes along, so a retry never sends an outdated state and the newer
+    frame is not sent twice. The publish callable has to abandon a message once it
+    failed or was cancelled, it must not deliver it again on its own.
+
+    The nodes of a frame which could not be published at all are passed to mark after
+    ack_timeout, so they get another frame with their latest state.
+    """
+
+    def __init__(
+        self,
+        queue: UpdateQueue,
+        publish: Callable[[str, bytes, int, bool], Awaitable],
+        logger: logging.Logger,
+        window: int = 16,
+        retries: int = 3,
+        ack_timeout: float = 5.0,
+        retry_delay: float = 0.1,
+        mark: Optional[Callable[[Node], None]] = None,
+    ):
+        self.logger = logger
+        self._queue = queue
+        self._publish = publish
+        self._mark = mark
+        self.window = window
+        self.retries = retries
+        self.ack_timeout = ack_timeout
+        self.retry_delay = retry_delay
+
+        self._slots = asyncio.Semaphore(window)
+        self._in_flight: Set[str] = set()
+        self._tasks: Set[asyncio.Future] = set()
+        # frames waiting for the frame in flight on their topic, per frame key
+        self._waiting: Dict[str, Dict[Hashable, Frame]] = {}
+        self._started: Optional[float] = None
+
+        self.stats = Counter()
+
+    def idle(self) -> bool:
+        return not self._in_flight and self._queue.empty()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._started = loop.time()
+        try:
+            while True:
+                await self._slots.acquire()
+                nodes = await self._queue.get()
+                topic = nodes[0].topic
+                key = FrameCoalescer.frame_key(nodes[0])
+                if topic in self._in_flight:
+                    waiting = self._waiting.setdefault(topic, {})
+                    if key in waiting:
+                        nodes = FrameCoalescer.merge(waiting[key], nodes)
+                    waiting[key] = nodes
+                    self._slots.release()
+                    continue
+
+                self._in_flight.add(topic)
+                self.stats["max_in_flight"] = max(
+                    self.stats["max_in_flight"], len(self._in_flight)
+                )
+                # keeps a reference, the loop only holds weak ones to running tasks
+                task = asyncio.ensure_future(self._send(topic, {key: nodes}))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        """
+        Stop all publishes in flight
+        """
+        for task in self._tasks:
+            task.cancel()
+
+    async def _send(self, topic: str, frames: Dict[Hashable, Frame]):
+        try:
+            while frames:
+                for key, nodes in frames.items():
+                    await self._send_frame(topic, key, nodes)
+                frames = self._waiting.pop(topic, {})
+        finally:
+            self._in_flight.discard(topic)
+            self._slots.release()
+
+    async def _send_frame(self, topic: str, key: Hashable, nodes: Frame):
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            msg = FrameCoalescer.render(nodes)
+            payload = str(msg.payload).encode()
+            start = loop.time()
+            try:
+                await asyncio.wait_for(
+                    self._publish(msg.topic, payload, msg.qos, msg.retain),
+                    self.ack_timeout,
+                )
+            except Exception as e:
+                if msg.qos == 0 or attempt == self.retries:
+                    self.stats["failed"] += 1
+                    self.logger.warning("publishing on %s failed: %r", topic, e)
+                    if self._mark is not None:
+                        # the coalescer already dropped them, a later frame has to
+                        # deliver the final state
+                        for node in nodes:
+                            loop.call_later(self.ack_timeout, self._mark, node)
+                    return
+                self.stats["retries"] += 1
+                await asyncio.sleep(self.retry_delay * 2**attempt)
+                waiting = self._waiting.get(topic, {}).pop(key, None)
+                if waiting is not None:
+                    nodes = FrameCoalescer.merge(nodes, waiting)
+                    self.stats["deduplicated"] += 1
+                continue
+
+            latency = loop.time() - start
+            self.stats["published"] += 1
+            self.stats["bytes"] += len(payload)
+            self.stats["latency_ms"] += latency * 1000
+            self.stats["max_latency_ms"] = max(
+                self.stats["max_latency_ms"], latency * 1000
+            )
+            return
+
+    def to_dict(self) -> Dict:
+        """
+        Counters, mean publish latency and throughput since the start
+        """
+        published = self.stats["published"]
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = asyncio.get_event_loop().time() - self._started
+        return {
+            **self.stats,
+            "in_flight": len(self._in_flight),
+            "latency_ms": round(self.stats["latency_ms"], 3),
+            "max_latency_ms": round(self.stats["max_latency_ms"], 3),
+            "mean_latency_ms": round(
+                self.stats["latency_ms"] / published if published else 0.0, 3
+            ),
+            "published_per_s": round(published / elapsed if elapsed else 0.0, 1),
+        }
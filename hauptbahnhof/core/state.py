@@ -1,114 +1,324 @@
-import asyncio
 import json
 import logging
-from typing import Dict, List, Tuple, Set
+import math
+from array import array
+from collections import Counter
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional, Tuple
 
+from .coalesce import FrameCoalescer
 from .config import Config
+from .fade import EASINGS, FadeEngine
+from .history import History
 from .node import create_nodes_from_config, Node
+from .store import ChannelStore
 from .translation import Translation
-from .utils import MQTTUpdate, StateUpdate
+from .updatequeue import PRIORITY_NORMAL, UpdateQueue
+from .utils import StateUpdate
+
+Route = Tuple[Tuple[Node, int], ...]
+
+# the light settings hackerman used before scenes, used if the config does not
+# define these scenes itself
+DEFAULT_SCENES: Dict[str, Dict] = {
+    "open": {
+        "nodes": {
+            "/haspa/licht/w": 400,
+            "/haspa/licht/c": 100,
+            "/haspa/licht/tisch": 1,
+            "/haspa/tisch/r": 160,
+            "/haspa/tisch/g": 100,
+            "/haspa/tisch/b": 70,
+            "/haspa/tisch/w": 90,
+        }
+    },
+    "close": {"nodes": {"/haspa/licht": 0}},
+}
 
 
 class State:
-    def __init__(self, nodes: List, translation: Translation, logger: logging.Logger):
+    def __init__(
+        self,
+        nodes: List,
+        translation: Translation,
+        logger: logging.Logger,
+        max_frame_rate: Optional[float] = None,
+        history: Optional[History] = None,
+        fade_rate: float = 50,
+        scenes: Optional[Dict[str, Dict]] = None,
+    ):
         self.logger = logger
         self._state = {}
 
         self.nodes = nodes
         self.translation = translation
 
-        self.ws_update_queue: asyncio.Queue[List[StateUpdate]] = asyncio.Queue()
-        self.mqtt_update_queue = asyncio.Queue()
+        self.stats = Counter()
+        # incremented on every change of the state
+        self.version = 0
+        self._json_cache: Tuple[int, Optional[str]] = (-1, None)
+
+        # all channel values live in one store, nodes are views into it
+        self.store = ChannelStore(sum(node.channels for node in nodes))
+        offset = 0
+        for node in nodes:
+            node.bind(self.store, offset)
+            offset += node.channels
+
+        # maps every base topic to the (node, channel index) pairs it controls
+        self._routes: Dict[str, Route] = self._build_routes(nodes)
+        # base topics and the store index they are read from for state snapshots
+        store_indices = {
+            topic: route[-1][0].offset + route[-1][1]
+            for topic, route in self._routes.items()
+        }
+        self._store_indices = store_indices
+        self._topics: Tuple[str, ...] = tuple(store_indices)
+        indices = tuple(store_indices.values())
+        # itemgetter only returns a tuple for more than one index
+        self._read_values: Callable[[array], Tuple[int, ...]] = (
+            itemgetter(*indices)
+            if len(indices) > 1
+            else lambda values: tuple(values[i] for i in indices)
+        )
+
+        # latest value per base topic and pending frame per node group, never grow
+        # beyond the number of topics and nodes
+        self.ws_update_queue = UpdateQueue()
+        self.mqtt_update_queue = UpdateQueue(FrameCoalescer.merge)
+        # rate limits the frames per node before they reach the mqtt update queue
+        self.frames = FrameCoalescer(self.mqtt_update_queue, max_frame_rate, logger)
+        self.history = history if history is not None else History(self._topics)
+        self.fades = FadeEngine(self.apply, self.value, logger, fade_rate)
+
+        # scene name -> updates, applied like any other batch of updates
+        self.scenes: Dict[str, Dict] = scenes or {}
+        for name, scene in self.scenes.items():
+            for topic in scene.get("nodes", {}):
+                if not self.handles(topic):
+                    raise ValueError(f"scene {name} sets unknown topic {topic}")
+
+    @staticmethod
+    def _build_routes(nodes: List[Node]) -> Dict[str, Route]:
+        routes: Dict[str, List[Tuple[Node, int]]] = {}
+        for node in nodes:
+            for topic, index in node.mappings.items():
+                routes.setdefault(topic, []).append((node, index))
+
+        return {topic: tuple(route) for topic, route in routes.items()}
 
     async def init(self):
         for node in self.nodes:
-            await self.mqtt_update_queue.put(
-                MQTTUpdate(node.topic, node.state_as_mqtt_message())
-            )
+            self.frames.mark(node)
 
-    async def _update_node_state(self, topic: str, value: int) -> Tuple[List[StateUpdate], Set[Node]]:
+    def process_updates(self, updates: Dict, priority: int = PRIORITY_NORMAL) -> None:
         """
-        go through all of our registered nodes, check if the topic matches and update their internal state
+        Apply a batch of topic updates to the node state and queue the resulting
+        websocket and mqtt updates.
 
-        :returns: List of applied state updates, list of changed nodes
+        Topics are translated to their base topics and routed straight to the channels
+        they control, so the cost only depends on the number of touched channels.
+        Writes which do not change a channel are suppressed unless updates["force"] is
+        set, e.g. to resync the hardware. With updates["fade"] the topics are faded to
+        their new values instead. High priority updates overtake queued normal ones.
         """
-        did_update = False
-        updated_nodes = set()
-        for node in self.nodes:
-            valid_node = node.set_state_for_topic(topic, value)
-            if valid_node:
-                did_update = True
-                updated_nodes.add(node)
+        values = self._resolve(updates.get("nodes", {}))
 
-        updates = [StateUpdate(topic, value)] if did_update else []
+        fade = updates.get("fade")
+        force = bool(updates.get("force", False))
+        if fade is not None:
+            self._start_fade(values, fade, force, priority)
+            return
 
-        return updates, updated_nodes
+        # a direct write takes over from a running fade
+        self.fades.cancel(values)
+        self.apply(values, force, priority)
 
-    async def update_node_topic(self, topic: str, value: int) -> Tuple[List[StateUpdate], Set[Node]]:
+    def _resolve(self, nodes: Dict) -> Dict[str, int]:
         """
-        Process a value input on a topic with translation
+        :returns: validated values of all base topics the given topics translate to
         """
-        topics = self.translation.translate(topic)
-        if not topics:
-            # we expect a base topic here
-            return await self._update_node_state(topic, value)
+        values: Dict[str, int] = {}
+        for topic, value in nodes.items():
+            try:
+                value = int(value)
+            # int(1e999) overflows
+            except (TypeError, ValueError, OverflowError):
+                self.logger.warning("invalid value for topic %s: %s", topic, value)
+                continue
+            if not 0 <= value <= ChannelStore.MAX_VALUE:
+                self.logger.warning("value for topic %s out of range: %s", topic, value)
+                continue
 
-        updates: List[Tuple[List[StateUpdate], List[Node]]] = await asyncio.gather(
-            *[self._update_node_state(topic, value) for topic in topics]
-        )
-        state_updates = []
-        updated_nodes = set()
-        for update in updates:
-            # TODO: find a more pythonic way to do this
-            state_updates.extend(update[0])
-            updated_nodes = updated_nodes.union(update[1])
-
-        return state_updates, updated_nodes
-
-    async def process_updates(self, updates: Dict) -> None:
-        # process node updates
-        updates: List[Tuple[List[StateUpdate], List[Node]]] = await asyncio.gather(
-            *[
-                self.update_node_topic(topic, value)
-                for topic, value in updates.get("nodes", {}).items()
-            ]
-        )
-        state_updates = []
-        updated_nodes = set()
-        for update in updates:
-            # TODO: find a more pythonic way to do this
-            state_updates.extend(update[0])
-            updated_nodes = updated_nodes.union(update[1])
+            for base_topic in self.translation.translate(topic) or (topic,):
+                if base_topic in self._routes:
+                    values[base_topic] = value
+        return values
+
+    def _start_fade(
+        self,
+        values: Dict[str, int],
+        fade: Dict,
+        force: bool = False,
+        priority: int = PRIORITY_NORMAL,
+    ):
+        try:
+            duration = float(fade.get("duration", 0)) / 1000
+            easing = fade.get("easing", "linear")
+            # nan and inf would never finish or break the interpolation
+            valid = math.isfinite(duration) and isinstance(easing, str)
+        except (AttributeError, TypeError, ValueError):
+            valid = False
+        if not valid:
+            self.logger.warning("invalid fade: %s", fade)
+            return
+        if easing not in EASINGS:
+            self.logger.warning("unknown fade easing: %s", easing)
+            return
+
+        self.fades.start(values, duration, easing, priority=priority, force=force)
+
+    def apply(
+        self,
+        values: Dict[str, int],
+        force: bool = False,
+        priority: int = PRIORITY_NORMAL,
+    ) -> None:
+        """
+        Write values of base topics and queue the resulting websocket and mqtt updates
+        """
+        state_updates: List[StateUpdate] = []
+        # dict as an ordered set, nodes are published in the order they were touched
+        updated_nodes: Dict[Node, None] = {}
+        for base_topic, value in values.items():
+            changed = False
+            for node, index in self._routes[base_topic]:
+                if node.set_channel(index, value, force):
+                    changed = True
+                    updated_nodes[node] = None
+
+            if changed:
+                state_updates.append(StateUpdate(base_topic, value))
+            else:
+                self.stats["suppressed_writes"] += 1
 
         # insert any other state update processing here
-        await asyncio.gather(
-            self.ws_update_queue.put(state_updates),
-            *[self.mqtt_update_queue.put(MQTTUpdate(node.topic, node.state_as_mqtt_message())) for node in
-              updated_nodes]
+        if state_updates:
+            self.version += 1
+            self.ws_update_queue.put_all(
+                ((update.topic, update) for update in state_updates), priority
+            )
+            self.history.record(state_updates)
+        for node in updated_nodes:
+            self.frames.mark(node, priority)
+
+    def apply_scene(self, name: str, priority: int = PRIORITY_NORMAL) -> bool:
+        """
+        Set all values of a scene in a single batch
+
+        :returns: whether the scene exists
+        """
+        # the name comes straight from the client and might not be hashable
+        scene = self.scenes.get(name) if isinstance(name, str) else None
+        if scene is None:
+            self.logger.warning("unknown scene %s", name)
+            return False
+
+        self.stats["scenes"] += 1
+        self.process_updates(scene, priority)
+        return True
+
+    def value(self, base_topic: str) -> int:
+        return self.store.values[self._store_indices[base_topic]]
+
+    def restore(self, snapshot: bytes) -> None:
+        """
+        Replace all channel values with a snapshot of the channel store
+        """
+        self.store.restore(snapshot)
+        self.version += 1
+
+    def layout(self) -> str:
+        """
+        Describes how the channel store is laid out, snapshots only fit the same layout
+        """
+        return "\n".join(
+            f"{type(node).__name__} {node.topic} {node.channels} "
+            + " ".join(f"{t}={i}" for t, i in sorted(node.mappings.items()))
+            for node in self.nodes
         )
 
+    @property
+    def topics(self) -> Tuple[str, ...]:
+        """
+        All base topics of the state
+        """
+        return self._topics
+
     def to_dict(self) -> Dict:
-        state_dict = {"nodes": {}, **self._state}
-        for node in self.nodes:
-            state_dict["nodes"].update(node.to_dict())
-        return state_dict
+        nodes = dict(zip(self._topics, self._read_values(self.store.values)))
+        return {"nodes": nodes, **self._state}
 
     def to_json(self) -> str:
-        return json.dumps(self.to_dict())
+        """
+        The encoded state, cached until the next change of the state version
+        """
+        version, encoded = self._json_cache
+        if version == self.version:
+            self.stats["json_cache_hits"] += 1
+            return encoded
 
-    def get_mqtt_topics(self) -> List[str]:
-        topics = self.translation.topics
-        for node in self.nodes:
-            topics.extend(node.mappings.keys())
+        self.stats["json_cache_misses"] += 1
+        encoded = json.dumps(self.to_dict())
+        self._json_cache = (self.version, encoded)
+        return encoded
+
+    def handles(self, topic: str) -> bool:
+        """
+        Whether topic is a base topic or translates to base topics
+        """
+        return topic in self._routes or self.translation.translate(topic) is not None
 
-        return topics
+    def get_mqtt_topics(self) -> List[str]:
+        """
+        :returns: all topics the state listens on, translations may contain wildcards
+        """
+        topics = set(self.translation.topics)
+        topics.update(self._routes)
+        return sorted(topics)
 
     @classmethod
     def from_config(cls, config: Config, logger: logging.Logger) -> "State":
+        nodes = create_nodes_from_config(config, logger)
+        base_topics = {topic for node in nodes for topic in node.mappings}
+        translation = Translation.from_config(config, base_topics=base_topics)
+        history_config = config.get("history", {})
+
+        # default scenes only set the topics this config knows
+        scenes = dict(config.get("scenes", {}))
+        for name, scene in DEFAULT_SCENES.items():
+            if name not in scenes:
+                scenes[name] = {
+                    "nodes": {
+                        topic: value
+                        for topic, value in scene["nodes"].items()
+                        if topic in base_topics or translation.translate(topic)
+                    }
+                }
+
         state = cls(
-            nodes=create_nodes_from_config(config, logger),
-            translation=Translation.from_config(config),
+            nodes=nodes,
+            translation=translation,
             logger=logger,
+            max_frame_rate=config.get("mqtt", {}).get("max_frame_rate", 50),
+            fade_rate=config.get("state", {}).get("fade_rate", 50),
+            scenes=scenes,
+            history=History(
+                base_topics,
+                max_memory=history_config.get("max_memory", 16 * 1024 * 1024),
+                max_samples=history_config.get("max_samples", 16384),
+                max_points=history_config.get("max_points", 2000),
+            ),
         )
 
         return state
@@ -0,0 +1,59 @@
+from array import array
+from typing import List
+
+
+class ChannelStore:
+    """
+    Contiguous storage for the channel values of all nodes.
+
+    Nodes are views into the store at a fixed offset, which makes snapshots and diffs
+    of the whole state simple buffer operations.
+    """
+
+    __slots__ = ("values",)
+
+    TYPECODE = "H"
+    MAX_VALUE = 0xFFFF
+    # number of channels compared at once when diffing snapshots
+    DIFF_BLOCK = 64
+
+    def __init__(self, size: int):
+        self.values = array(self.TYPECODE, bytes(size * array(self.TYPECODE).itemsize))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def snapshot(self) -> bytes:
+        return self.values.tobytes()
+
+    def restore(self, snapshot: bytes) -> None:
+        values = array(self.TYPECODE)
+        values.frombytes(snapshot)
+        if len(values) != len(self.values):
+            raise ValueError(
+                f"snapshot of {len(values)} channels does not fit store of {len(self.values)}"
+            )
+        self.values[:] = values
+
+    def diff(self, snapshot: bytes) -> List[int]:
+        """
+        :returns: indices of all channels that changed since the snapshot was taken
+        """
+        current = self.values.tobytes()
+        if current == snapshot:
+            return []
+
+        itemsize = self.values.itemsize
+        block = self.DIFF_BLOCK * itemsize
+        changed = []
+        # compare whole blocks as bytes and only look at the channels of differing ones
+        for start in range(0, len(current), block):
+            if current[start : start + block] == snapshot[start : start + block]:
+                continue
+            for offset in range(start, min(start + block, len(current)), itemsize):
+                if (
+                    current[offset : offset + itemsize]
+                    != snapshot[offset : offset + itemsize]
+                ):
+                    changed.append(offset // itemsize)
+        return changed
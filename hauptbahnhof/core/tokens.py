@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import logging
+import os
+import secrets
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+def _digest(token: str) -> str:
+    # only token hashes are kept, a leaked snapshot does not leak valid tokens
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenStore:
+    """
+    Authentication tokens of the websocket API.
+
+    Tokens expire against the monotonic clock. Validation is a single dict lookup,
+    expired tokens are removed by a periodic sweep over a min heap ordered by expiry.
+    If a snapshot file is configured the tokens survive a restart of the core.
+    """
+
+    def __init__(
+        self,
+        validity_seconds: float,
+        logger: logging.Logger,
+        snapshot_file: Optional[Path] = None,
+        sweep_interval: float = 60,
+    ):
+        self.logger = logger
+        self._validity_seconds = validity_seconds
+        self._snapshot_file = snapshot_file
+        self._sweep_interval = sweep_interval
+
+        # token digest -> monotonic expiry time
+        self._tokens: Dict[str, float] = {}
+        # (expiry, token digest), may contain stale entries of revoked tokens
+        self._expiry: List[Tuple[float, str]] = []
+
+        if self._snapshot_file is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def _add(self, digest: str, expires: float):
+        self._tokens[digest] = expires
+        heapq.heappush(self._expiry, (expires, digest))
+
+    def issue(self) -> Tuple[str, datetime]:
+        """
+        Create a new token
+
+        :returns: token and its expiry time
+        """
+        token = secrets.token_hex(32)
+        self._add(_digest(token), time.monotonic() + self._validity_seconds)
+        self._save()
+
+        return token, datetime.now() + timedelta(seconds=self._validity_seconds)
+
+    def is_valid(self, token: Optional[str]) -> bool:
+        if not isinstance(token, str):
+            return False
+
+        expires = self._tokens.get(_digest(token))
+        return expires is not None and expires > time.monotonic()
+
+    def refresh(self, token: Optional[str]) -> Optional[Tuple[str, datetime]]:
+        """
+        Replace a valid token with a new one
+        """
+        if not self.is_valid(token):
+            return None
+
+        del self._tokens[_digest(token)]
+        return self.issue()
+
+    def sweep(self) -> int:
+        """
+        Remove all expired tokens
+
+        :returns: number of removed tokens
+        """
+        now = time.monotonic()
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, digest = heapq.heappop(self._expiry)
+            # skip entries of tokens which were refreshed in the meantime
+            if self._tokens.get(digest) == expires:
+                del self._tokens[digest]
+                removed += 1
+
+        if removed:
+            self._save()
+        return removed
+
+    def _save(self):
+        if self._snapshot_file is None:
+            return
+
+        # persist wall clock expiry times, the monotonic clock restarts with the host
+        offset = time.time() - time.monotonic()
+        snapshot = {
+            digest: expires + offset for digest, expires in self._tokens.items()
+        }
+        tmp_file = self._snapshot_file.with_name(self._snapshot_file.name + ".tmp")
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, self._snapshot_file)
+        except OSError as e:
+            self.logger.error(
+                "could not write token snapshot %s: %s", self._snapshot_file, e
+            )
+
+    def _load(self):
+        try:
+            with self._snapshot_file.open("r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError) as e:
+            self.logger.error(
+                "could not read token snapshot %s: %s", self._snapshot_file, e
+            )
+            return
+
+        offset = time.time() - time.monotonic()
+        for digest, expires in snapshot.items():
+            if expires - offset > time.monotonic():
+                self._add(digest, expires - offset)
+        self.logger.info("restored %d tokens from %s", len(self), self._snapshot_file)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._sweep_interval)
+            removed = self.sweep()
+            if removed:
+                self.logger.debug("removed %d expired tokens", removed)
+
+    @classmethod
+    def from_config(cls, config: Dict, logger: logging.Logger) -> "TokenStore":
+        """
+        :param config: the websocket config section
+        """
+        snapshot_file = config.get("token_store_file")
+        return cls(
+            validity_seconds=config.get("token_validity_seconds", 3600),
+            logger=logger,
+            snapshot_file=Path(snapshot_file) if snapshot_file else None,
+            sweep_interval=config.get("token_sweep_interval", 60),
+        )
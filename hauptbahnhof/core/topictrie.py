@@ -0,0 +1,124 @@
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+def is_filter(topic: str) -> bool:
+    """
+    Whether topic contains the + or # wildcard
+    """
+    return any(level in ("+", "#") for level in topic.split("/"))
+
+
+def matches(topic_filter: str, topic: str) -> bool:
+    """
+    Whether topic matches the mqtt topic filter
+    """
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    # "a/#" matches "a" as well
+    return len(levels) == len(filter_levels) or filter_levels[len(levels)] == "#"
+
+
+def covering_filters(
+    topics: Iterable[str], depth: int = 2, exclude: Iterable[str] = ()
+) -> List[str]:
+    """
+    A few filters which match all of topics, every topic is covered by a # filter on
+    its first depth levels, e.g. /haspa/# for /haspa/licht/1/c. A filter which would
+    match one of the exclude topics goes a level deeper, down to the topic itself.
+    """
+    exclude = tuple(exclude)
+    # whether a candidate filter matches none of exclude, shared by many topics
+    allowed: Dict[str, bool] = {}
+    filters = set()
+    for topic in topics:
+        levels = topic.split("/")
+        for level in range(depth, max(depth, len(levels)) + 1):
+            if "#" in levels[:level]:
+                filters.add("/".join(levels[: levels.index("#") + 1]))
+                break
+            candidate = "/".join(levels[:level] + ["#"])
+            if candidate not in allowed:
+                allowed[candidate] = not any(matches(candidate, t) for t in exclude)
+            if allowed[candidate]:
+                filters.add(candidate)
+                break
+        else:
+            filters.add(topic)
+    return sorted(filters)
+
+
+class _TrieNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children: Dict[str, _TrieNode] = {}
+        # (insertion number, value) of the filters ending in this node
+        self.values: List[Tuple[int, Any]] = []
+
+
+class TopicTrie:
+    """
+    Maps mqtt topic filters to values.
+
+    Matching a topic walks the trie level by level, so it only depends on the length
+    of the topic and the number of wildcard branches it hits, not on the number of
+    filters.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, topic_filter: str, value: Any):
+        """
+        :raises ValueError: if # is not the last level of the filter
+        """
+        levels = topic_filter.split("/")
+        if "#" in levels[:-1]:
+            raise ValueError(f"# has to be the last level of filter {topic_filter}")
+
+        node = self._root
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TrieNode()
+            node = child
+        node.values.append((self._size, value))
+        self._size += 1
+
+    def match(self, topic: str) -> List[Any]:
+        """
+        :returns: values of all filters matching topic, in the order they were added
+        """
+        found: List[Tuple[int, Any]] = []
+        nodes = [self._root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if "#" in children:
+                    found.extend(children["#"].values)
+                if level in children:
+                    next_nodes.append(children[level])
+                if "+" in children:
+                    next_nodes.append(children["+"])
+            nodes = next_nodes
+            if not nodes:
+                break
+        else:
+            for node in nodes:
+                found.extend(node.values)
+                # "a/#" matches "a" as well
+                if "#" in node.children:
+                    found.extend(node.children["#"].values)
+
+        found.sort(key=lambda entry: entry[0])
+        return [value for _, value in found]
@@ -1,43 +1,130 @@
-from typing import List, Dict, Set, Optional
+import sys
+from typing import List, Dict, Optional, Iterable, Tuple
 
 from hauptbahnhof.core import Config
+from hauptbahnhof.core.topictrie import is_filter, matches, TopicTrie
 
-MAX_RECURSION_DEPTH = 10
+# upper bound of distinct topics whose wildcard translation is kept
+MAX_CACHED_TOPICS = 4096
 
 
-class RecursionDepthExceeded(Exception):
+class TranslationError(Exception):
     pass
 
 
 class Translation:
-    def __init__(self, mappings: Dict[str, List[str]]):
+    def __init__(
+        self,
+        mappings: Dict[str, List[str]],
+        base_topics: Optional[Iterable[str]] = None,
+    ):
+        """
+        :param mappings: maps a topic to the list of topics it translates to. Topics
+            and targets may contain the mqtt wildcards + and #, a wildcard target
+            stands for all topics it matches.
+        :param base_topics: topics a translation may end in, if given every mapping
+            has to resolve to these
+        """
         self._mappings = mappings
+        self._base_topics = frozenset(base_topics or ())
+        self._closure = self._compute_closure(
+            mappings, None if base_topics is None else set(base_topics)
+        )
 
-    def _translate(self, topic, depth=0) -> Set[str]:
-        if topic not in self._mappings:
-            return {topic}
+        # wildcard mappings apply to topics which are neither mapped nor base topics
+        self._wildcards = TopicTrie()
+        for mapping in mappings:
+            if is_filter(mapping):
+                self._wildcards.add(mapping, self._closure[mapping])
+        self._wildcard_cache: Dict[str, Tuple[str, ...]] = {}
 
-        if depth < MAX_RECURSION_DEPTH:
-            return set().union(
-                *[self._translate(t, depth + 1) for t in self._mappings[topic]]
-            )
-        else:
-            raise RecursionDepthExceeded()
+    @staticmethod
+    def _compute_closure(
+        mappings: Dict[str, List[str]], base_topics: Optional[set]
+    ) -> Dict[str, Tuple[str, ...]]:
+        """
+        Resolve every mapping to the deduplicated tuple of base topics it ends in.
 
-    def translate(self, topic) -> Optional[Set[str]]:
-        if topic not in self._mappings:
+        :raises TranslationError: if the mappings contain a cycle or a mapping target
+            is neither a mapping itself nor a base topic
+        """
+        closure: Dict[str, Tuple[str, ...]] = {}
+        # topics a wildcard target can stand for
+        candidates = [mapping for mapping in mappings if not is_filter(mapping)]
+        candidates.extend(base_topics or ())
+
+        def expand(topic: str, target: str) -> List[str]:
+            if not is_filter(target):
+                return [target]
+            expanded = [
+                candidate for candidate in candidates if matches(target, candidate)
+            ]
+            if not expanded:
+                raise TranslationError(
+                    f"translation target {target} of {topic} matches no topic"
+                )
+            return expanded
+
+        def resolve(topic: str, path: List[str]) -> Tuple[str, ...]:
+            if topic in closure:
+                return closure[topic]
+            if topic in path:
+                cycle = " -> ".join(path[path.index(topic) :] + [topic])
+                raise TranslationError(f"translation cycle detected: {cycle}")
+
+            path.append(topic)
+            # dict as an ordered set
+            leaves: Dict[str, None] = {}
+            targets = [t for target in mappings[topic] for t in expand(topic, target)]
+            for target in targets:
+                if target in mappings:
+                    leaves.update(dict.fromkeys(resolve(target, path)))
+                elif base_topics is None or target in base_topics:
+                    leaves[sys.intern(target)] = None
+                else:
+                    raise TranslationError(
+                        f"translation target {target} of {topic} does not exist"
+                    )
+            path.pop()
+
+            closure[topic] = tuple(leaves)
+            return closure[topic]
+
+        for mapping in mappings:
+            resolve(mapping, [])
+
+        return closure
+
+    def translate(self, topic) -> Optional[Tuple[str, ...]]:
+        translated = self._closure.get(topic)
+        if translated is not None or not self._wildcards:
+            return translated
+        if topic in self._base_topics:
             return None
 
-        return self._translate(topic)
+        translated = self._wildcard_cache.get(topic)
+        if translated is None:
+            # dict as an ordered set
+            leaves: Dict[str, None] = {}
+            for closure in self._wildcards.match(topic):
+                leaves.update(dict.fromkeys(closure))
+            translated = tuple(leaves)
+            if len(self._wildcard_cache) < MAX_CACHED_TOPICS:
+                self._wildcard_cache[topic] = translated
+        return translated or None
 
     @property
     def topics(self) -> List[str]:
-        topics = set()
-        for mapping, mapped in self._mappings.items():
-            topics.add(mapping)
-            topics.update(set(mapped))
+        """
+        All mapped topics, including wildcard ones, and the topics they translate to
+        """
+        topics = set(self._mappings)
+        for closure in self._closure.values():
+            topics.update(closure)
         return list(topics)
 
     @classmethod
-    def from_config(cls, config: Config) -> "Translation":
-        return cls(config.get("translation", {}))
+    def from_config(
+        cls, config: Config, base_topics: Optional[Iterable[str]] = None
+    ) -> "Translation":
+        return cls(config.get("translation", {}), base_topics=base_topics)
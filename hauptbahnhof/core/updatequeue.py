@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+# safety actions and privileged commands, served before everything else
+PRIORITY_HIGH = 0
+# regular updates, e.g. effects and fades
+PRIORITY_NORMAL = 1
+
+
+class UpdateQueue:
+    """
+    Queue of updates keyed by the topic or node they are for.
+
+    An update for a key which is still queued replaces the queued one in place, merged
+    with it if a merge function is given, so a stalled consumer only ever finds the
+    latest value per key. The queue is therefore bounded by the number of keys and
+    never has to drop an update.
+
+    Every priority has its own lane, higher priority updates are taken out first.
+    """
+
+    def __init__(self, merge: Optional[Callable[[Any, Any], Any]] = None):
+        self._merge = merge
+        # key -> (item, enqueue time) per priority
+        self._lanes: Tuple[Dict[Hashable, Tuple[Any, float]], ...] = ({}, {})
+        self._priority: Dict[Hashable, int] = {}
+        self._not_empty = asyncio.Event()
+
+        self.stats = Counter()
+
+    def __len__(self) -> int:
+        return len(self._priority)
+
+    def empty(self) -> bool:
+        return not self._priority
+
+    def put_nowait(
+        self, key: Hashable, item: Any, priority: int = PRIORITY_NORMAL
+    ) -> None:
+        self.put_all(((key, item),), priority)
+
+    def put_all(
+        self, items: Iterable[Tuple[Hashable, Any]], priority: int = PRIORITY_NORMAL
+    ) -> None:
+        """
+        Queue several (key, update) pairs of the same priority
+        """
+        now = time.monotonic()
+        lane = self._lanes[priority]
+        queued_priority = self._priority
+        for key, item in items:
+            queued = queued_priority.get(key)
+            if queued is not None:
+                old, enqueued = self._lanes[queued][key]
+                if self._merge is not None:
+                    item = self._merge(old, item)
+                self.stats["collapsed"] += 1
+                if priority >= queued:
+                    self._lanes[queued][key] = (item, enqueued)
+                    continue
+                # moves up to the higher priority lane
+                del self._lanes[queued][key]
+            else:
+                enqueued = now
+
+            lane[key] = (item, enqueued)
+            queued_priority[key] = priority
+
+        if len(queued_priority) > self.stats["max_depth"]:
+            self.stats["max_depth"] = len(queued_priority)
+        if queued_priority:
+            self._not_empty.set()
+
+    def get_nowait(self) -> Any:
+        for lane in self._lanes:
+            if lane:
+                key = next(iter(lane))
+                item, enqueued = lane.pop(key)
+                del self._priority[key]
+                wait = time.monotonic() - enqueued
+                self.stats["items"] += 1
+                self.stats["wait_ms"] += int(wait * 1000)
+                self.stats["max_wait_ms"] = max(
+                    self.stats["max_wait_ms"], int(wait * 1000)
+                )
+                return item
+        raise asyncio.QueueEmpty()
+
+    async def get(self) -> Any:
+        while not self._priority:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def drain(self) -> List[Any]:
+        """
+        :returns: all queued updates, highest priority first
+        """
+        now = time.monotonic()
+        items = []
+        for lane in self._lanes:
+            if not lane:
+                continue
+            entries = lane.values()
+            items.extend(item for item, _ in entries)
+            waited = len(lane) * now - sum(enqueued for _, enqueued in entries)
+            oldest = next(iter(entries))[1]
+            self.stats["items"] += len(lane)
+            self.stats["wait_ms"] += int(waited * 1000)
+            self.stats["max_wait_ms"] = max(
+                self.stats["max_wait_ms"], int((now - oldest) * 1000)
+            )
+            lane.clear()
+        self._priority.clear()
+        return items
+
+    def to_dict(self) -> Dict:
+        """
+        Depth and counters for the stats message
+        """
+        return {
+            "depth": len(self._priority),
+            "high_priority_depth": len(self._lanes[PRIORITY_HIGH]),
+            **self.stats,
+        }
@@ -1,4 +1,6 @@
 from collections import namedtuple
 
-MQTTUpdate = namedtuple("MQTTUpdate", ("topic", "payload"))
+MQTTUpdate = namedtuple(
+    "MQTTUpdate", ("topic", "payload", "qos", "retain"), defaults=(0, False)
+)
 StateUpdate = namedtuple("StateUpdate", ("topic", "value"))
@@ -3,33 +3,51 @@ import json
 import logging
 import secrets
 import ssl
-from datetime import datetime, timedelta
+import time
+from collections import Counter, deque
+from datetime import datetime
+from fnmatch import fnmatchcase
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Optional, Tuple, List
+from typing import Callable, Deque, Dict, FrozenSet, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
 
 import websockets
 from websockets import WebSocketServerProtocol
 
+from . import binary
+from .client import Client, OVERFLOW_RESYNC
 from .config import Config
 from .state import State
+from .tokens import TokenStore
+from .updatequeue import PRIORITY_HIGH, PRIORITY_NORMAL
 from .utils import StateUpdate
 
+# upper bound of distinct subscriptions whose resolved topic sets are kept
+MAX_SUBSCRIPTIONS = 256
 
-async def _send_error(websocket, error_code: int):
-    msg = {"type": "error", "code": error_code}
-    await websocket.send(json.dumps(msg))
+
+def _resume_from(path: str) -> Optional[Dict]:
+    """
+    Parse the resume position of a reconnecting client from ?epoch=<epoch>&seq=<seq>
+    """
+    query = parse_qs(urlsplit(path).query)
+    try:
+        return {"epoch": query["epoch"][0], "seq": int(query["seq"][0])}
+    except (KeyError, ValueError):
+        return None
 
 
 def authenticated(func):
     async def wrapped(self, websocket, msg: Dict, requires_auth: bool = False):
         if (
             requires_auth
-            and self._is_authenticated(msg.get("token"))
+            and self.tokens.is_valid(msg.get("token"))
             or not requires_auth
         ):
             await func(self, websocket, msg)
         else:
-            await _send_error(websocket, 403)
+            self._send_error(websocket, 403)
 
     return wrapped
 
@@ -39,7 +57,7 @@ def privileged(func):
         if not requires_auth:
             await func(self, websocket, msg)
         else:
-            await _send_error(websocket, 403)
+            self._send_error(websocket, 403)
 
     return wrapped
 
@@ -52,10 +70,7 @@ class WebSocket:
 
         self.block_unprivileged = False
 
-        self.cache: Dict[str, datetime] = {}
-        self._token_validity_time = timedelta(
-            seconds=self.config.get("token_alidity_seconds", 3600)
-        )
+        self.tokens = TokenStore.from_config(self.config, logger)
 
         # initialize ssl
         self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -63,59 +78,183 @@ class WebSocket:
             Path(self.config.get("chainfile")), Path(self.config.get("private_key"))
         )
 
-        self.connections = set()
+        self.stats = Counter()
+        # counters of other parts of the core, included in the stats message
+        self.stats_providers: Dict[str, Callable[[], Dict]] = {}
+        self.connections: Dict[WebSocketServerProtocol, Client] = {}
+        self._send_queue_size = self.config.get("send_queue_size", 256)
+        self._slow_client_policy = self.config.get(
+            "slow_client_policy", OVERFLOW_RESYNC
+        )
 
-    async def _send_state(self, websocket: WebSocketServerProtocol):
-        update = {
-            "type": "state",
-            "state": self.state.to_dict(),
-            "block_unprivileged": self.block_unprivileged,
-        }
-        await websocket.send(json.dumps(update))
+        # resolved topic sets per subscription, shared by all clients with equal patterns
+        self._subscriptions: Dict[Tuple[str, ...], FrozenSet[str]] = {}
+        # encoded state per subscribed topic set, valid for one state version
+        self._filtered_states: Dict[FrozenSet[str], str] = {}
+        self._filtered_states_version = -1
+
+        # every broadcast gets a sequence number, the last deltas are kept so
+        # reconnecting clients only need what they missed. The epoch tells sequence
+        # numbers of different core runs apart.
+        self._epoch = secrets.token_hex(4)
+        self._seq = 0
+        self._deltas: Deque[Tuple[int, Dict[str, int]]] = deque(
+            maxlen=self.config.get("resume_buffer_size", 256)
+        )
 
-    async def _send_client_info(self, websocket: WebSocketServerProtocol):
+        # topic ids for clients speaking the binary protocol
+        self._topic_dictionary = binary.TopicDictionary(state.topics)
+
+    def _resolve_subscription(self, patterns: Tuple[str, ...]) -> FrozenSet[str]:
+        """
+        Resolve subscription patterns to the set of matching base topics. Patterns
+        containing glob characters are matched with fnmatch, all others as prefix.
+        """
+        topics = self._subscriptions.get(patterns)
+        if topics is not None:
+            return topics
+
+        topics = frozenset(
+            topic
+            for topic in self.state.topics
+            if any(
+                (
+                    fnmatchcase(topic, pattern)
+                    if any(c in pattern for c in "*?[")
+                    else topic.startswith(pattern)
+                )
+                for pattern in patterns
+            )
+        )
+        if len(self._subscriptions) < MAX_SUBSCRIPTIONS:
+            self._subscriptions[patterns] = topics
+        return topics
+
+    def _filtered_state_json(self, topics: FrozenSet[str]) -> str:
+        if self._filtered_states_version != self.state.version:
+            self._filtered_states = {}
+            self._filtered_states_version = self.state.version
+
+        encoded = self._filtered_states.get(topics)
+        if encoded is None:
+            state = self.state.to_dict()
+            state["nodes"] = {t: v for t, v in state["nodes"].items() if t in topics}
+            encoded = self._filtered_states[topics] = json.dumps(state)
+        return encoded
+
+    def _state_frame(self, topics: Optional[FrozenSet[str]] = None) -> str:
+        # the state itself is only encoded once per state version and subscription
+        if topics is None:
+            state = self.state.to_json()
+        else:
+            state = self._filtered_state_json(topics)
+        return (
+            '{"type": "state", "state": %s, "block_unprivileged": %s, '
+            '"epoch": "%s", "seq": %d}'
+            % (state, json.dumps(self.block_unprivileged), self._epoch, self._seq)
+        )
+
+    def _update_frame(self, nodes: Dict[str, int], client: Client) -> Union[str, bytes]:
+        if client.binary:
+            return self._topic_dictionary.encode_update(nodes, self._seq)
+        msg = {"type": "state_update", "seq": self._seq, "updates": {"nodes": nodes}}
+        return json.dumps(msg)
+
+    def _missed_updates(self, epoch: str, seq: int) -> Optional[Dict[str, int]]:
+        """
+        Merge all deltas broadcast after seq.
+
+        :returns: the merged node updates, None if they are not available anymore
+        """
+        if epoch != self._epoch or not isinstance(seq, int) or seq > self._seq:
+            return None
+        if seq == self._seq:
+            return {}
+        if not self._deltas or self._deltas[0][0] > seq + 1:
+            return None
+
+        nodes = {}
+        # sequence numbers in the buffer are consecutive
+        for _, delta in islice(self._deltas, seq + 1 - self._deltas[0][0], None):
+            nodes.update(delta)
+        return nodes
+
+    def _send(self, websocket: WebSocketServerProtocol, frame: str):
+        """
+        Queue a frame for the given connection, never waits for the client
+        """
+        self.connections[websocket].send(frame)
+
+    def _send_error(self, websocket: WebSocketServerProtocol, error_code: int):
+        msg = {"type": "error", "code": error_code}
+        self._send(websocket, json.dumps(msg))
+
+    def _send_state(
+        self, websocket: WebSocketServerProtocol, resume: Optional[Dict] = None
+    ) -> bool:
+        """
+        Send the full state, or only the missed updates if the client can resume from
+        the epoch and seq of the last state update it received.
+
+        :returns: whether the client resumed
+        """
+        client = self.connections[websocket]
+        if isinstance(resume, dict):
+            nodes = self._missed_updates(resume.get("epoch"), resume.get("seq"))
+            if nodes is not None:
+                if client.topics is not None:
+                    nodes = {t: v for t, v in nodes.items() if t in client.topics}
+                self._send(websocket, self._update_frame(nodes, client))
+                self.stats["resumed_sessions"] += 1
+                return True
+
+        self._send(websocket, self._state_frame(client.topics))
+        return False
+
+    def _send_client_info(self, websocket: WebSocketServerProtocol):
         client_ip = websocket.remote_address[0]
         client_info = {
             "type": "client_info",
             "client_ip": client_ip,
             "privileged_address": f'ws://{self.config.get("internal_host")}:{self.config.get("internal_port")}',
             "unprivileged_address": f'wss://{self.config.get("external_host")}:{self.config.get("external_port")}',
+            "scenes": sorted(self.state.scenes),
         }
-        await websocket.send(json.dumps(client_info))
-
-    async def send_update(self, msg: Dict):
-        encoded_msg = json.dumps(msg)
-        await asyncio.gather(*[conn.send(encoded_msg) for conn in self.connections])
-
-    def _refresh_cache(self):
-        for token in list(self.cache.keys()):
-            if self.cache[token] <= datetime.now():
-                del self.cache[token]
+        self._send(websocket, json.dumps(client_info))
+
+    def send_update(self, nodes: Dict[str, int]):
+        """
+        Broadcast changed node values, encoded once per distinct subscription
+        """
+        frames: Dict[
+            Tuple[Optional[FrozenSet[str]], bool], Optional[Union[str, bytes]]
+        ] = {}
+        for client in self.connections.values():
+            key = (client.topics, client.binary)
+            if key not in frames:
+                filtered = nodes
+                if client.topics is not None:
+                    filtered = {t: v for t, v in nodes.items() if t in client.topics}
+                frames[key] = None
+                if filtered:
+                    frames[key] = self._update_frame(filtered, client)
+                    self.stats["broadcast_frames"] += 1
+
+            if frames[key] is not None:
+                client.broadcast(frames[key])
 
     async def _register(self, websocket: WebSocketServerProtocol):
-        self.connections.add(websocket)
+        self.connections[websocket] = Client(
+            websocket,
+            queue_size=self._send_queue_size,
+            overflow_policy=self._slow_client_policy,
+            resync_frame=self._state_frame,
+            stats=self.stats,
+            logger=self.logger,
+        )
 
     async def _unregister(self, websocket: WebSocketServerProtocol):
-        self.connections.remove(websocket)
-        self._refresh_cache()
-
-    def _generate_token(self) -> Tuple[str, datetime]:
-        token = secrets.token_hex(32)
-        expires_at = datetime.now() + self._token_validity_time
-        self.cache[token] = expires_at
-
-        return token, expires_at
-
-    def _refresh_token(self, token: str) -> Optional[Tuple[str, datetime]]:
-        if self._is_authenticated(token):
-            del self.cache[token]
-            token, expires_at = self._generate_token()
-            return token, expires_at
-
-        return None
-
-    def _is_authenticated(self, token: str) -> bool:
-        return token in self.cache and self.cache[token] > datetime.now()
+        self.connections.pop(websocket).stop()
 
     def _authenticate(
         self, username: str, password: str
@@ -124,7 +263,7 @@ class WebSocket:
             username in self.config.get("users", {})
             and self.config.get("users", {})[username] == password
         ):
-            token, expires_at = self._generate_token()
+            token, expires_at = self.tokens.issue()
             self.logger.debug(
                 "authenticated user %s, token expires at %s", username, expires_at
             )
@@ -140,15 +279,89 @@ class WebSocket:
             self.block_unprivileged = msg["block_unprivileged"]
             self.logger.info("updated block_unprivileged = %s", self.block_unprivileged)
 
+    @privileged
+    async def _handle_stats(self, websocket: WebSocketServerProtocol, msg: Dict):
+        stats = {
+            "state": self.state.stats,
+            "frames": self.state.frames.stats,
+            "websocket": self.stats,
+            "tokens": {"active": len(self.tokens)},
+            "queues": {
+                "websocket": self.state.ws_update_queue.to_dict(),
+                "mqtt": self.state.mqtt_update_queue.to_dict(),
+            },
+            "history": {
+                **self.state.history.stats,
+                "memory": self.state.history.memory(),
+            },
+            **{name: provider() for name, provider in self.stats_providers.items()},
+        }
+        self._send(websocket, json.dumps({"type": "stats", "stats": stats}))
+
+    @privileged
+    async def _handle_history(self, websocket: WebSocketServerProtocol, msg: Dict):
+        patterns = msg.get("topics")
+        now = int(time.time() * 1000)
+        start, end = msg.get("from", 0), msg.get("to", now)
+        bucket = msg.get("bucket")
+        if (
+            not isinstance(patterns, list)
+            or not all(isinstance(p, str) for p in patterns)
+            or not all(isinstance(t, int) for t in (start, end))
+            or not (bucket is None or isinstance(bucket, int) and bucket > 0)
+        ):
+            self.logger.warning("received invalid history message: %s", msg)
+            self._send_error(websocket, 400)
+            return
+
+        topics = self._resolve_subscription(tuple(sorted(set(patterns))))
+        history = await self.state.history.query_async(
+            sorted(topics), start, end, bucket
+        )
+        self._send(
+            websocket,
+            json.dumps(
+                {"type": "history", "from": start, "to": end, "topics": history}
+            ),
+        )
+
+    @authenticated
+    async def _handle_subscribe(self, websocket: WebSocketServerProtocol, msg: Dict):
+        patterns = msg.get("topics")
+        if not isinstance(patterns, list) or not all(
+            isinstance(p, str) for p in patterns
+        ):
+            self.logger.warning("received invalid subscribe message: %s", msg)
+            self._send_error(websocket, 400)
+            return
+
+        client = self.connections[websocket]
+        client.topics = (
+            self._resolve_subscription(tuple(sorted(set(patterns))))
+            if patterns
+            else None
+        )
+        self._send_state(websocket)
+
+    def _priority(self, websocket: WebSocketServerProtocol) -> int:
+        # commands of the local privileged clients overtake bulk traffic
+        client = self.connections[websocket]
+        return PRIORITY_HIGH if client.privileged else PRIORITY_NORMAL
+
+    @authenticated
+    async def _handle_scene(self, websocket: WebSocketServerProtocol, msg: Dict):
+        if not self.state.apply_scene(msg.get("scene"), self._priority(websocket)):
+            self._send_error(websocket, 400)
+
     @authenticated
     async def _handle_state_update(self, websocket: WebSocketServerProtocol, msg: Dict):
-        await self.state.process_updates(msg.get("updates", {}))
+        self.state.process_updates(msg.get("updates", {}), self._priority(websocket))
 
     async def _handle_ws_message(
         self, websocket: WebSocketServerProtocol, msg: Dict, requires_auth: bool = True
     ):
         if self.block_unprivileged and requires_auth:
-            await _send_error(websocket, 503)
+            self._send_error(websocket, 503)
             return
 
         msg_type = msg.get("type")
@@ -158,21 +371,34 @@ class WebSocket:
         if msg_type == "update_troll_block":
             await self._handle_update_troll_block(websocket, msg, requires_auth)
 
+        if msg_type == "stats":
+            await self._handle_stats(websocket, msg, requires_auth)
+
+        if msg_type == "scene":
+            await self._handle_scene(websocket, msg, requires_auth)
+
+        if msg_type == "history":
+            await self._handle_history(websocket, msg, requires_auth)
+
+        if msg_type == "subscribe":
+            await self._handle_subscribe(websocket, msg, requires_auth)
+
         if msg_type == "refresh_token":
-            token = self._refresh_token(msg.get("token"))
+            token = self.tokens.refresh(msg.get("token"))
             if token:
-                await websocket.send(
+                self._send(
+                    websocket,
                     json.dumps(
                         {
                             "type": "authenticated",
                             "token": token[0],
                             "expires_at": int(token[1].timestamp()),
                         }
-                    )
+                    ),
                 )
-                await self._send_state(websocket)
+                self._send_state(websocket, msg.get("resume"))
             else:
-                await _send_error(websocket, 403)
+                self._send_error(websocket, 403)
 
         elif msg_type == "authenticate":
             if "password" not in msg or "username" not in msg:
@@ -181,16 +407,17 @@ class WebSocket:
                 )
             token = self._authenticate(msg["username"], msg["password"])
             if token:
-                await websocket.send(
+                self._send(
+                    websocket,
                     json.dumps(
                         {
                             "type": "authenticated",
                             "token": token[0],
                             "expires_at": int(token[1].timestamp()),
                         }
-                    )
+                    ),
                 )
-                await self._send_state(websocket)
+                self._send_state(websocket, msg.get("resume"))
 
     async def ws_handler(
         self, websocket: WebSocketServerProtocol, path: str, requires_auth=True
@@ -201,11 +428,14 @@ class WebSocket:
             not requires_auth,
         )
         await self._register(websocket)
+        self.connections[websocket].privileged = not requires_auth
         try:
-            if not requires_auth:
-                await self._send_state(websocket)
+            if self.connections[websocket].binary:
+                self._send(websocket, self._topic_dictionary.to_json())
 
-            await self._send_client_info(websocket)
+            # a reconnecting client already knows its client info
+            if requires_auth or not self._send_state(websocket, _resume_from(path)):
+                self._send_client_info(websocket)
 
             while True:
                 msg = await websocket.recv()
@@ -224,17 +454,33 @@ class WebSocket:
         await self.ws_handler(websocket, path, requires_auth=False)
 
     async def state_handler(self):
+        """
+        Broadcast state updates to all clients, at most broadcast_rate frames per second.
+
+        All updates queued until the next broadcast tick are merged into one frame, only
+        the latest value of every topic is sent.
+        """
         self.logger.info("started websocket state update loop")
+        rate = self.config.get("broadcast_rate", 30)
+        interval = 1 / rate if rate else 0
+        loop = asyncio.get_event_loop()
+        last_broadcast = float("-inf")
         while True:
-            updates: List[StateUpdate] = await self.state.ws_update_queue.get()
-            update_msg = {
-                "type": "state_update",
-                "updates": {
-                    "nodes": {update.topic: update.value for update in updates}
-                },
-            }
-
-            await self.send_update(update_msg)
+            update: StateUpdate = await self.state.ws_update_queue.get()
+            # the first update after an idle period is sent right away
+            delay = last_broadcast + interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # the queue holds the latest value per topic, high priority topics first
+            updates = [update] + self.state.ws_update_queue.drain()
+            nodes = {update.topic: update.value for update in updates}
+            self.stats["merged_state_updates"] += len(updates) - 1
+
+            last_broadcast = loop.time()
+            self._seq += 1
+            self._deltas.append((self._seq, nodes))
+            self.send_update(nodes)
 
     def start_server(self):
         return asyncio.gather(
@@ -243,10 +489,12 @@ class WebSocket:
                 self.config.get("external_host"),
                 self.config.get("external_port"),
                 ssl=self.ssl_context,
+                subprotocols=[binary.SUBPROTOCOL],
             ),
             websockets.serve(
                 self.ws_handler_privileged,
                 self.config.get("internal_host"),
                 self.config.get("internal_port"),
+                subprotocols=[binary.SUBPROTOCOL],
             ),
         )
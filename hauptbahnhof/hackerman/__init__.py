@@ -1,11 +1,13 @@
+import asyncio
 import json
-import time
+import threading
 from json import JSONDecodeError
 
 import requests
-import random
 
 from hauptbahnhof.core import HauptbahnhofModule
+from .effects import EFFECTS
+from .timeline import EffectEngine
 
 
 class Hackerman(HauptbahnhofModule):
@@ -13,8 +15,10 @@ class Hackerman(HauptbahnhofModule):
     Scan the local hackerspace network for new and unknown devices to send back a result
     """
 
-    def __init__(self):
-        super().__init__("hackerman")
+    def __init__(self, host=None):
+        super().__init__("hackerman", host)
+        self._loop = asyncio.new_event_loop()
+        self.effects = EffectEngine(EFFECTS, self.publish, self.play_sound, self.logger)
 
     def on_connect(self, client, userdata, flags, rc):
         super().on_connect(client, userdata, flags, rc)
@@ -41,24 +45,18 @@ class Hackerman(HauptbahnhofModule):
             return
 
         if message["haspa"] in ["open", "offen", "auf"]:
-            # set the best of all possible light settings
-            self.publish("/haspa/licht/w", 400)
-            self.publish("/haspa/licht/c", 100)
-            self.publish("/haspa/licht/tisch", 1)
-            self.publish("/haspa/tisch/r", 160)
-            self.publish("/haspa/tisch/g", 100)
-            self.publish("/haspa/tisch/b", 70)
-            self.publish("/haspa/tisch/w", 90)
+            # set the best of all possible light settings, configured as scene in the core
+            self.publish("/haspa/scene", {"scene": "open"})
 
             self.publish("/haspa/music/control", {"play": True})
         elif message["haspa"] in ["close", "zu", "closed"]:
-            self.publish("/haspa/licht", 0)
+            self.publish("/haspa/scene", {"scene": "close"})
             self.publish("/haspa/music/control", {"play": False})
         else:
             self.logger.warning("Haspa state undetermined: %s", {message["haspa"]})
 
     def command_action(self, client, userdata, msg):
-        """ Handle actions like alarm or party """
+        """Handle actions like alarm or party"""
         try:
             message = json.loads(msg.payload)
         except JSONDecodeError:
@@ -69,91 +67,34 @@ class Hackerman(HauptbahnhofModule):
             self.logger.warning(f"got invalid action msg: {message}")
             return
 
-        if message["action"] == "alarm":
-            self.logger.info("Performing alarm...")
-            self.publish("/haspa/licht/alarm", 1)
-            time.sleep(2)
-            self.publish("/haspa/licht/alarm", 0)
-
-        elif message["action"] == "strobo":
-            self.logger.info("Performing strobo...")
-            for i in range(100):
-                self.publish("/haspa/licht/c", 0)
-                time.sleep(0.05)
-                self.publish("/haspa/licht/c", 1023)
-                time.sleep(0.03)
-
-        elif message["action"] == "party":
-            self.logger.info("Performing party...")
-            self.publish("/haspa/licht", 0)
-            self.publish("/haspa/licht/c", 0)
-            self.publish("/haspa/licht/w", 0)
-            delay = 0.05
-
-            sounds = [
-                # ('56', 3.5), # führer
-                ("97", 4.7),  # sonnenschein
-                ("63", 5),  # epische musik
-                ("110", 3.7),  # dota
-                ("113", 9),  # skrillex
-            ]
-
-            sound = random.choice(sounds)
-
-            if sound[0] == "97":
-                time.sleep(1)
-                for i in range(0, 300):
-                    if i == 100:
-                        requests.get("https://bot.stusta.de/set/" + sound[0])
-
-                    self.publish("/haspa/licht/w", i * 10 / 3)
-                    time.sleep(0.01)
-
-            elif sound[0] == "113":
-                requests.get("https://bot.stusta.de/set/" + sound[0])
-                for i in range(2):
-                    time.sleep(1.5)
-                    self.publish("/haspa/licht/1/c", 1023)
-                    self.publish("/haspa/licht/1/c", 1023)
-                    self.publish("/haspa/licht/alarm", 1)
-
-                    time.sleep(0.01)
-                    self.publish("/haspa/licht/c", 0)
-
-                    for o in range(40):
-                        self.publish("/haspa/licht/c", 20 * o)
-                        time.sleep(0.01)
-
-                    self.publish("/haspa/licht/c", 0)
-
-                    # time.sleep(1.49)
-                    for o in range(20):
-                        self.publish("/haspa/licht/1/c", 1023)
-                        self.publish("/haspa/licht/3/c", 0)
-
-                        time.sleep(0.01)
-
-                        self.publish("/haspa/licht/1/c", 0)
-                        self.publish("/haspa/licht/3/c", 1023)
-                        time.sleep(0.01)
-
-            else:
-                requests.get("https://bot.stusta.de/set/" + sound[0])
-                for _ in range(int(sound[1] / (delay * 4))):
-                    self.publish("/haspa/licht/3/c", 0)
-                    self.publish("/haspa/licht/1/c", 1023)
-                    time.sleep(delay)
-
-                    self.publish("/haspa/licht/1/c", 0)
-                    self.publish("/haspa/licht/4/c", 1023)
-                    time.sleep(delay)
-
-                    self.publish("/haspa/licht/4/c", 0)
-                    self.publish("/haspa/licht/2/c", 1023)
-                    time.sleep(delay)
-
-                    self.publish("/haspa/licht/2/c", 0)
-                    self.publish("/haspa/licht/3/c", 1023)
-                    time.sleep(delay)
-
-            self.publish("/haspa/licht", 300)
+        action = message["action"]
+        if action == "stop":
+            self._loop.call_soon_threadsafe(self.effects.cancel)
+        elif action == "status":
+            future = asyncio.run_coroutine_threadsafe(self._running(), self._loop)
+            self.publish("/haspa/action/status", {"running": future.result(timeout=1)})
+        elif action in self.effects.effects:
+            try:
+                tempo = float(message.get("tempo", 1.0))
+            except (TypeError, ValueError):
+                self.logger.warning(f"got invalid action tempo: {message}")
+                return
+            self.logger.info("Performing %s...", action)
+            self._loop.call_soon_threadsafe(self.effects.play, action, tempo)
+        else:
+            self.logger.warning("unknown action %s", action)
+
+    async def _running(self):
+        return self.effects.running()
+
+    def play_sound(self, sound: str):
+        requests.get("https://bot.stusta.de/set/" + sound)
+
+    def start(self):
+        # effects run on their own loop, the mqtt network loop never waits for them
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self.effects.cancel)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        super().stop()
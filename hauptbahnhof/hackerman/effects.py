@@ -0,0 +1,133 @@
+"""
+Effects hackerman plays on /haspa/action, see timeline.compile_timeline for the format.
+"""
+
+
+def _sound_flash(sound: str, duration: float) -> dict:
+    # running light over the four cold white lights for the length of the sound
+    delay = 0.05
+    return {
+        "steps": [
+            {"at": 0, "sound": sound},
+            {
+                "at": 0,
+                "timeline": {
+                    "loop": int(duration / (delay * 4)),
+                    "length": delay * 4,
+                    "steps": [
+                        {
+                            "at": 0,
+                            "set": {"/haspa/licht/3/c": 0, "/haspa/licht/1/c": 1023},
+                        },
+                        {
+                            "at": delay,
+                            "set": {"/haspa/licht/1/c": 0, "/haspa/licht/4/c": 1023},
+                        },
+                        {
+                            "at": delay * 2,
+                            "set": {"/haspa/licht/4/c": 0, "/haspa/licht/2/c": 1023},
+                        },
+                        {
+                            "at": delay * 3,
+                            "set": {"/haspa/licht/2/c": 0, "/haspa/licht/3/c": 1023},
+                        },
+                    ],
+                },
+            },
+            {"at": duration, "set": {"/haspa/licht": 300}},
+        ]
+    }
+
+
+_PARTY_START = {"/haspa/licht": 0, "/haspa/licht/c": 0, "/haspa/licht/w": 0}
+
+_SONNENSCHEIN = {
+    "steps": [
+        {"at": 0, "set": _PARTY_START},
+        {"at": 1, "fade": {"/haspa/licht/w": 1000}, "duration": 3},
+        {"at": 2, "sound": "97"},
+        {"at": 4, "set": {"/haspa/licht": 300}},
+    ]
+}
+
+_SKRILLEX = {
+    "steps": [
+        {"at": 0, "set": _PARTY_START},
+        {"at": 0, "sound": "113"},
+        {
+            "at": 0,
+            "timeline": {
+                "loop": 2,
+                "length": 2.32,
+                "steps": [
+                    {
+                        "at": 1.5,
+                        "set": {"/haspa/licht/1/c": 1023, "/haspa/licht/alarm": 1},
+                    },
+                    {"at": 1.51, "set": {"/haspa/licht/c": 0}},
+                    {"at": 1.51, "fade": {"/haspa/licht/c": 800}, "duration": 0.4},
+                    {"at": 1.91, "set": {"/haspa/licht/c": 0}},
+                    {
+                        "at": 1.91,
+                        "timeline": {
+                            "loop": 20,
+                            "length": 0.02,
+                            "steps": [
+                                {
+                                    "at": 0,
+                                    "set": {
+                                        "/haspa/licht/1/c": 1023,
+                                        "/haspa/licht/3/c": 0,
+                                    },
+                                },
+                                {
+                                    "at": 0.01,
+                                    "set": {
+                                        "/haspa/licht/1/c": 0,
+                                        "/haspa/licht/3/c": 1023,
+                                    },
+                                },
+                            ],
+                        },
+                    },
+                ],
+            },
+        },
+        {"at": 4.7, "set": {"/haspa/licht": 300}},
+    ]
+}
+
+EFFECTS = {
+    "alarm": {
+        "steps": [
+            {"at": 0, "set": {"/haspa/licht/alarm": 1}},
+            {"at": 2, "set": {"/haspa/licht/alarm": 0}},
+        ]
+    },
+    "strobo": {
+        "loop": 100,
+        "length": 0.08,
+        "steps": [
+            {"at": 0, "set": {"/haspa/licht/c": 0}},
+            {"at": 0.05, "set": {"/haspa/licht/c": 1023}},
+        ],
+    },
+    "party": {
+        "variants": [
+            _SONNENSCHEIN,
+            {
+                "steps": [
+                    {"at": 0, "set": _PARTY_START},
+                    {"at": 0, "timeline": _sound_flash("63", 5)},
+                ]
+            },
+            {
+                "steps": [
+                    {"at": 0, "set": _PARTY_START},
+                    {"at": 0, "timeline": _sound_flash("110", 3.7)},
+                ]
+            },
+            _SKRILLEX,
+        ]
+    },
+}
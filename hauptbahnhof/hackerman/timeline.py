@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import random
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# (time in seconds, step)
+Event = Tuple[float, Dict]
+
+# the core applies all topics of a message on this topic as one update
+STATE_SET_TOPIC = "/haspa/state/set"
+
+
+def compile_timeline(timeline: Dict, offset: float = 0.0) -> List[Event]:
+    """
+    Flatten a timeline into events sorted by their time.
+
+    A timeline is a dict of "steps", each with the time "at" which it happens relative
+    to the start of the timeline. It is played "loop" times, every iteration takes
+    "length" seconds which defaults to the time of its last step. A step either
+    "set"s topics to values, "fade"s them over "duration" seconds, plays a "sound" or
+    contains a nested "timeline".
+    """
+    steps = timeline.get("steps", [])
+    length = timeline.get("length", max((step["at"] for step in steps), default=0))
+
+    events: List[Event] = []
+    for iteration in range(timeline.get("loop", 1)):
+        start = offset + iteration * length
+        for step in steps:
+            if "timeline" in step:
+                events.extend(compile_timeline(step["timeline"], start + step["at"]))
+            else:
+                events.append((start + step["at"], step))
+
+    # sort is stable, steps at the same time keep their order
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+class RunningEffect:
+    __slots__ = ("name", "events", "tempo", "start", "position", "max_lateness", "task")
+
+    def __init__(self, name: str, events: List[Event], tempo: float, start: float):
+        self.name = name
+        self.events = events
+        self.tempo = tempo
+        self.start = start
+        self.position = 0
+        self.max_lateness = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def duration(self) -> float:
+        return self.events[-1][0] / self.tempo if self.events else 0.0
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "elapsed": round(now - self.start, 3),
+            "duration": round(self.duration, 3),
+            "step": self.position,
+            "steps": len(self.events),
+            "tempo": self.tempo,
+            "max_lateness": round(self.max_lateness, 4),
+        }
+
+
+class EffectEngine:
+    """
+    Plays effect timelines on the asyncio loop.
+
+    Every event is scheduled against the monotonic loop clock relative to the start of
+    the effect, so a late publish does not delay the events after it. Starting an effect
+    that is already running restarts it, all effects can be cancelled at any point.
+    """
+
+    def __init__(
+        self,
+        effects: Dict[str, Dict],
+        publish: Callable[[str, Union[int, Dict]], None],
+        play_sound: Callable[[str], None],
+        logger: logging.Logger,
+    ):
+        self.effects = effects
+        self.logger = logger
+        self._publish = publish
+        self._play_sound = play_sound
+        self._running: Dict[str, RunningEffect] = {}
+
+        self.stats = Counter()
+
+    def play(self, name: str, tempo: float = 1.0) -> bool:
+        """
+        Start an effect, an effect with variants plays a random one of them
+
+        :returns: whether the effect exists
+        """
+        effect = self.effects.get(name)
+        if effect is None or tempo <= 0:
+            return False
+        if "variants" in effect:
+            effect = random.choice(effect["variants"])
+
+        self.cancel(name)
+        loop = asyncio.get_event_loop()
+        running = RunningEffect(name, compile_timeline(effect), tempo, loop.time())
+        running.task = asyncio.ensure_future(self._run(running))
+        self._running[name] = running
+        self.stats["effects"] += 1
+        self.logger.info("playing effect %s", name)
+        return True
+
+    def cancel(self, name: Optional[str] = None):
+        """
+        Stop an effect or all of them
+        """
+        names = list(self._running) if name is None else [name]
+        for name in names:
+            running = self._running.pop(name, None)
+            if running is not None:
+                running.task.cancel()
+                self.stats["cancelled_effects"] += 1
+
+    def running(self) -> Dict[str, Dict]:
+        now = asyncio.get_event_loop().time()
+        return {name: effect.to_dict(now) for name, effect in self._running.items()}
+
+    def _apply(self, step: Dict, tempo: float):
+        # one publish per step, however many lights it changes
+        if "set" in step:
+            self._publish(STATE_SET_TOPIC, {"nodes": step["set"]})
+        if "fade" in step:
+            duration = round(step.get("duration", 0) / tempo * 1000)
+            self._publish(
+                STATE_SET_TOPIC,
+                {"nodes": step["fade"], "fade": {"duration": duration}},
+            )
+        if "sound" in step:
+            # the sound bot is an http request, keep it off the loop
+            asyncio.get_event_loop().run_in_executor(
+                None, self._play_sound, step["sound"]
+            )
+
+    async def _run(self, effect: RunningEffect):
+        loop = asyncio.get_event_loop()
+        try:
+            for effect.position, (at, step) in enumerate(effect.events):
+                target = effect.start + at / effect.tempo
+                delay = target - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                effect.max_lateness = max(effect.max_lateness, loop.time() - target)
+
+                self._apply(step, effect.tempo)
+                self.stats["events"] += 1
+        finally:
+            if self._running.get(effect.name) is effect:
+                del self._running[effect.name]
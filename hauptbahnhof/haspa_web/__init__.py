@@ -15,8 +15,8 @@ class HaspaWeb(HauptbahnhofModule):
     -- This will connect to a remote hauptbahnhof client!
     """
 
-    def __init__(self):
-        super().__init__("haspa_web")
+    def __init__(self, host=None):
+        super().__init__("haspa_web", host)
 
         prism_path = Path(__file__).resolve().parent
         self.config["TEMPLATE_PATH"] = prism_path / "templates"
@@ -27,7 +27,7 @@ class HaspaWeb(HauptbahnhofModule):
         self.subscribe("/haspa/status", self.command_state)
 
     def command_state(self, client, userdata, mqttmsg):
-        """ /haspa/status change detected """
+        """/haspa/status change detected"""
         del client, userdata
         message = json.loads(mqttmsg.payload.decode("utf-8"))
         self.logger.info("Received: %s", message)
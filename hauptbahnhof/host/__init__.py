@@ -0,0 +1,171 @@
+import importlib
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+import paho.mqtt.client as mqtt
+
+from hauptbahnhof.core import HauptbahnhofModule
+from hauptbahnhof.core.config import Config
+
+# module name -> class, modules can be started as separate processes or in a host
+MODULES = {
+    "hackerman": "hauptbahnhof.hackerman:Hackerman",
+    "nsa": "hauptbahnhof.nsa:NSA",
+    "mpd": "hauptbahnhof.mpd:MPD",
+    "haspa_web": "hauptbahnhof.haspa_web:HaspaWeb",
+}
+
+
+class HostedConnection:
+    """
+    The part of the mqtt client a hosted module uses, backed by the host connection
+    """
+
+    def __init__(self, host: "ModuleHost", module: HauptbahnhofModule):
+        self._host = host
+        self._module = module
+
+    def subscribe(self, topic: str):
+        self._host.subscribe(topic)
+
+    def message_callback_add(self, topic: str, callback: Callable):
+        self._host.add_callback(self._module, topic, callback)
+
+    def publish(self, topic: str, payload=None):
+        return self._host.client.publish(topic, payload)
+
+
+class ModuleHost:
+    """
+    Runs several modules in one process with a single broker connection.
+
+    Messages are dispatched to the modules by their subscriptions, every module keeps
+    its own worker pool, so a slow or failing module does not affect the others. A
+    module which fails to start or connect is restarted after restart_delay seconds.
+    """
+
+    def __init__(
+        self,
+        config_dir: str,
+        config: Config,
+        modules: List[str],
+        logger: logging.Logger,
+        restart_delay: float = 5,
+    ):
+        self.logger = logger
+        self.config_dir = config_dir
+        self.config = config
+        self.restart_delay = restart_delay
+
+        unknown = set(modules) - set(MODULES)
+        if unknown:
+            raise ValueError(f"unknown modules {', '.join(sorted(unknown))}")
+        self.module_names = modules
+        self.modules: Dict[str, HauptbahnhofModule] = {}
+
+        self.client = mqtt.Client(client_id="hauptbahnhof-host")
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.enable_logger(self.logger)
+
+        self._lock = threading.Lock()
+        self._connected = False
+        self._subscriptions = set()
+        # subscription -> module name -> callback
+        self._callbacks: Dict[str, Dict[str, Callable]] = {}
+
+    def connection(self, module: HauptbahnhofModule) -> HostedConnection:
+        return HostedConnection(self, module)
+
+    def subscribe(self, topic: str):
+        with self._lock:
+            if topic in self._subscriptions:
+                return
+            self._subscriptions.add(topic)
+        self.client.subscribe(topic)
+
+    def add_callback(self, module: HauptbahnhofModule, topic: str, callback: Callable):
+        with self._lock:
+            self._callbacks.setdefault(topic, {})[module.name] = callback
+
+    def _on_message(self, client, userdata, msg):
+        with self._lock:
+            callbacks = [
+                callback
+                for topic, module_callbacks in self._callbacks.items()
+                if mqtt.topic_matches_sub(topic, msg.topic)
+                for callback in module_callbacks.values()
+            ]
+        # the callbacks only queue the message on the worker pool of their module
+        for callback in callbacks:
+            callback(client, userdata, msg)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.logger.info("Connected to mqtt broker on %s", self.config["mqtt"]["host"])
+        with self._lock:
+            self._connected = True
+            self._subscriptions.clear()
+        for module in list(self.modules.values()):
+            self._connect_module(module, flags, rc)
+
+    def _connect_module(self, module: HauptbahnhofModule, flags=None, rc=0):
+        try:
+            module.on_connect(self.client, None, flags, rc)
+        except Exception:
+            self.logger.exception("module %s failed to connect", module.name)
+            self.restart(module.name)
+
+    def start_module(self, name: str):
+        module_path, class_name = MODULES[name].split(":")
+        try:
+            module_class = getattr(importlib.import_module(module_path), class_name)
+            module = module_class(host=self)
+            module.start()
+        except Exception:
+            self.logger.exception(
+                "module %s failed to start, retrying in %s s", name, self.restart_delay
+            )
+            threading.Timer(self.restart_delay, self.start_module, [name]).start()
+            return
+
+        self.modules[name] = module
+        self.logger.info("started module %s", name)
+        if self._connected:
+            self._connect_module(module)
+
+    def restart(self, name: str):
+        """
+        Stop a module and start it again after restart_delay seconds
+        """
+        module = self.modules.pop(name, None)
+        if module is None:
+            return
+
+        with self._lock:
+            for module_callbacks in self._callbacks.values():
+                module_callbacks.pop(name, None)
+        try:
+            module.stop()
+        except Exception:
+            self.logger.exception("module %s failed to stop", name)
+
+        self.logger.warning("restarting module %s in %s s", name, self.restart_delay)
+        threading.Timer(self.restart_delay, self.start_module, [name]).start()
+
+    def run(self):
+        for name in self.module_names:
+            self.start_module(name)
+
+        while True:
+            try:
+                self.client.connect(self.config["mqtt"]["host"])
+                break
+            except ConnectionRefusedError as e:
+                self.logger.error(
+                    "Failed when trying initial connect to mqtt server: %s", e
+                )
+                time.sleep(5)
+
+        self.client.loop_forever()
@@ -0,0 +1,45 @@
+import argparse
+import logging
+
+from hauptbahnhof.core import LOG_FORMAT
+from hauptbahnhof.core.config import Config
+from hauptbahnhof.host import MODULES, ModuleHost
+
+
+def create_parser():
+    parser = argparse.ArgumentParser("Hauptbahnhof module host")
+    parser.add_argument("--config-dir", type=str, default="/etc/hauptbahnhof")
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        choices=sorted(MODULES),
+        help="modules to run, defaults to host.modules in hauptbahnhof.json",
+    )
+
+    return parser
+
+
+def main():
+    """
+    Run several modules in one process
+    """
+    args = create_parser().parse_args()
+    config = Config.from_file(f"{args.config_dir}/hauptbahnhof.json")
+    host_config = config.get("host", {})
+
+    logging.basicConfig(format=LOG_FORMAT)
+    logger = logging.getLogger("host")
+    logger.setLevel(logging.DEBUG if config.get("debug", False) else logging.INFO)
+
+    host = ModuleHost(
+        config_dir=args.config_dir,
+        config=config,
+        modules=args.modules or host_config.get("modules", sorted(MODULES)),
+        logger=logger,
+        restart_delay=host_config.get("restart_delay", 5),
+    )
+    host.run()
+
+
+if __name__ == "__main__":
+    main()
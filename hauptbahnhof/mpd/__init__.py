@@ -11,8 +11,8 @@ class MPD(HauptbahnhofModule):
     Implement Interfacing to a locally running mpd server
     """
 
-    def __init__(self):
-        super().__init__("mpd")
+    def __init__(self, host=None):
+        super().__init__("mpd", host)
 
     def on_connect(self, client, userdata, flags, rc):
         super().on_connect(client, userdata, flags, rc)
@@ -10,8 +10,8 @@ class NSA(HauptbahnhofModule):
     Scan the local hackerspace network for new and unknown devices to send back a result
     """
 
-    def __init__(self):
-        super().__init__("nsa")
+    def __init__(self, host=None):
+        super().__init__("nsa", host)
         try:
             self._load_config("arplist")
         except FileNotFoundError:
@@ -24,7 +24,8 @@ setup(
         "hauptbahnhof.hackerman",
         "hauptbahnhof.nsa",
         "hauptbahnhof.haspa_web",
-        "hauptbahnhof.mpd"
+        "hauptbahnhof.mpd",
+        "hauptbahnhof.host"
     ],
     # data_files=[
     #     (
@@ -36,7 +37,7 @@ setup(
     #         ["conf/hauptbahnhof.json", "conf/arplist.json"]
     #     ),
     # ],
-    install_requires=["paho-mqtt", "hbmqtt", "websockets", "requests"],
+    install_requires=["paho-mqtt", "hbmqtt==0.9.6", "websockets", "requests"],
     classifiers=[
         "Topic :: Internet :: WWW/HTTP",
         "Intended Audience :: Developers",
@@ -0,0 +1,929 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the hauptbahnhof core.
+
+Run from the repository root, e.g.
+
+    python3 util/benchmark.py routing --nodes 500
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from hauptbahnhof.core.binary import TopicDictionary  # noqa: E402
+from hauptbahnhof.core.coalesce import FrameCoalescer  # noqa: E402
+from hauptbahnhof.core.config import Config  # noqa: E402
+from hauptbahnhof.core.history import History  # noqa: E402
+from hauptbahnhof.core.ingest import MessageBatcher  # noqa: E402
+from hauptbahnhof.core.node import DFNode  # noqa: E402
+from hauptbahnhof.core.persistence import StateSnapshotFile  # noqa: E402
+from hauptbahnhof.core.publisher import Publisher  # noqa: E402
+from hauptbahnhof.core.state import State  # noqa: E402
+from hauptbahnhof.core.store import ChannelStore  # noqa: E402
+from hauptbahnhof.core.topictrie import TopicTrie, covering_filters, matches  # noqa
+from hauptbahnhof.core.translation import Translation  # noqa: E402
+from hauptbahnhof.core.utils import MQTTUpdate, StateUpdate  # noqa: E402
+from hauptbahnhof.hackerman.effects import EFFECTS  # noqa: E402
+from hauptbahnhof.hackerman.timeline import EffectEngine, compile_timeline  # noqa: E402
+
+CHANNELS = ("r", "g", "b", "w", "c", "uv", "a", "x")
+
+logger = logging.getLogger("benchmark")
+
+
+def synthetic_config(n_nodes: int) -> Config:
+    """
+    Create a config with n_nodes dfnodes with 8 channels each, grouped into rooms of
+    ten nodes with a translation per room and channel plus one for the whole space.
+    """
+    nodes = []
+    translation: Dict[str, list] = {}
+    for i in range(n_nodes):
+        room = i // 10
+        mappings = {}
+        for index, channel in enumerate(CHANNELS):
+            topic = f"/bench/{room}/{i}/{channel}"
+            mappings[topic] = index
+            translation.setdefault(f"/bench/{room}/{channel}", []).append(topic)
+        nodes.append(
+            {
+                "type": "dfnode",
+                "topic": "/bench/led",
+                "espid": f"{i:08x}",
+                "mappings": mappings,
+            }
+        )
+
+    rooms = (n_nodes + 9) // 10
+    translation["/bench"] = [
+        f"/bench/{room}/{channel}" for room in range(rooms) for channel in CHANNELS
+    ]
+
+    # no frame rate limit, every process_updates call flushes its frames
+    return Config(
+        {"mqtt": {"max_frame_rate": 0}, "nodes": nodes, "translation": translation}
+    )
+
+
+def _drain(state: State):
+    state.frames.flush(time.perf_counter())
+    state.ws_update_queue.drain()
+    state.mqtt_update_queue.drain()
+
+
+def _timeit(func: Callable[[], None], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+async def _legacy_process_updates(
+    state: State, updates: Dict, ws_queue: asyncio.Queue, mqtt_queue: asyncio.Queue
+):
+    """
+    The previous implementation of State.process_updates which scans every node for
+    every base topic
+    """
+
+    async def update_node_state(topic, value):
+        updated_nodes = set()
+        for node in state.nodes:
+            if node.set_state_for_topic(topic, value):
+                updated_nodes.add(node)
+        return ([StateUpdate(topic, value)] if updated_nodes else []), updated_nodes
+
+    async def update_node_topic(topic, value):
+        topics = state.translation.translate(topic)
+        if not topics:
+            return await update_node_state(topic, value)
+        results = await asyncio.gather(*[update_node_state(t, value) for t in topics])
+        state_updates, updated_nodes = [], set()
+        for result in results:
+            state_updates.extend(result[0])
+            updated_nodes = updated_nodes.union(result[1])
+        return state_updates, updated_nodes
+
+    results = await asyncio.gather(
+        *[update_node_topic(t, v) for t, v in updates.get("nodes", {}).items()]
+    )
+    state_updates, updated_nodes = [], set()
+    for result in results:
+        state_updates.extend(result[0])
+        updated_nodes = updated_nodes.union(result[1])
+    await asyncio.gather(
+        ws_queue.put(state_updates),
+        *[
+            mqtt_queue.put(MQTTUpdate(node.topic, node.state_as_mqtt_message()))
+            for node in updated_nodes
+        ],
+    )
+
+
+def bench_routing(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state = State.from_config(synthetic_config(args.nodes), logger)
+    scenarios = {
+        "single channel": "/bench/0/0/w",
+        "room group (10 ch)": "/bench/0/w",
+        f"whole space ({args.nodes * len(CHANNELS)} ch)": "/bench",
+    }
+    values = itertools.count()
+    # the previous implementation used unbounded asyncio queues
+    legacy_queues = (asyncio.Queue(), asyncio.Queue())
+
+    print(f"routing benchmark, {args.nodes} nodes")
+    for name, topic in scenarios.items():
+
+        # every write changes the value, unchanged writes are cheaper still
+        def routed():
+            state.process_updates({"nodes": {topic: next(values)}})
+            _drain(state)
+
+        def legacy():
+            updates = {"nodes": {topic: next(values)}}
+            loop.run_until_complete(
+                _legacy_process_updates(state, updates, *legacy_queues)
+            )
+            for queue in legacy_queues:
+                while not queue.empty():
+                    queue.get_nowait()
+
+        t_routed = _timeit(routed, args.repeat)
+        t_legacy = _timeit(legacy, args.repeat)
+        print(
+            f"  {name:28s} legacy {t_legacy * 1e6:10.1f} us"
+            f"  routed {t_routed * 1e6:10.1f} us  ({t_legacy / t_routed:6.1f}x)"
+        )
+    loop.close()
+
+
+class _LegacyNode:
+    """
+    The previous node layout, a plain object with a list of channel values
+    """
+
+    def __init__(self, topic: str, mappings: Dict[str, int]):
+        self.topic = topic
+        self.mappings = mappings
+        self._state = [0] * 8
+
+    def to_dict(self):
+        return {mapping: self._state[index] for mapping, index in self.mappings.items()}
+
+
+def _legacy_to_dict(nodes) -> Dict:
+    state_dict = {"nodes": {}}
+    for node in nodes:
+        state_dict["nodes"].update(node.to_dict())
+    return state_dict
+
+
+def _allocated(func: Callable[[], object]):
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_store(args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    config = synthetic_config(args.nodes)
+    channels = args.nodes * len(CHANNELS)
+
+    # mappings are the same in both layouts, only measure the nodes and their state
+    legacy_nodes, legacy_size = _allocated(
+        lambda: [_LegacyNode(n["topic"], {}) for n in config["nodes"]]
+    )
+    state = State.from_config(config, logger)
+
+    def bound_nodes():
+        nodes = [DFNode(n["espid"], n["topic"], {}) for n in config["nodes"]]
+        store = ChannelStore(channels)
+        for i, node in enumerate(nodes):
+            node.bind(store, i * node.channels)
+        return nodes
+
+    _, store_size = _allocated(bound_nodes)
+    legacy_nodes = [_LegacyNode(n["topic"], n["mappings"]) for n in config["nodes"]]
+
+    print(f"store benchmark, {args.nodes} nodes, {channels} channels")
+    print(
+        f"  memory per channel          legacy {legacy_size / channels:8.1f} B"
+        f"  store {store_size / channels:8.1f} B"
+    )
+
+    for i, node in enumerate(state.nodes):
+        node.set_channel(i % 8, i)
+        legacy_nodes[i]._state[i % 8] = i
+
+    def compare(name, legacy, new):
+        t_legacy = _timeit(legacy, args.repeat)
+        t_new = _timeit(new, args.repeat)
+        print(
+            f"  {name:26s} legacy {t_legacy * 1e6:10.1f} us"
+            f"  store {t_new * 1e6:10.1f} us  ({t_legacy / t_new:6.1f}x)"
+        )
+
+    compare("to_dict", lambda: _legacy_to_dict(legacy_nodes), state.to_dict)
+    compare(
+        "snapshot",
+        lambda: _legacy_to_dict(legacy_nodes),
+        state.store.snapshot,
+    )
+    legacy_snapshot = _legacy_to_dict(legacy_nodes)
+    snapshot = state.store.snapshot()
+    compare(
+        "diff (unchanged)",
+        lambda: _legacy_to_dict(legacy_nodes) == legacy_snapshot,
+        lambda: state.store.diff(snapshot),
+    )
+    state.nodes[0].set_channel(0, 1023)
+    legacy_nodes[0]._state[0] = 1023
+    compare(
+        "diff (one change)",
+        lambda: [
+            t
+            for t, v in _legacy_to_dict(legacy_nodes)["nodes"].items()
+            if legacy_snapshot["nodes"][t] != v
+        ],
+        lambda: state.store.diff(snapshot),
+    )
+
+
+def bench_protocol(args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    state = State.from_config(synthetic_config(args.nodes), logger)
+    dictionary = TopicDictionary(state.topics)
+    topics = state.topics
+
+    print(f"websocket protocol benchmark, {len(topics)} topics")
+    print(f"  topic dictionary sent once on connect: {len(dictionary.to_json())} B")
+    for n in (1, 10, len(topics)):
+        nodes = {topic: 1023 - i % 1024 for i, topic in enumerate(topics[:n])}
+        msg = {"type": "state_update", "seq": n, "updates": {"nodes": nodes}}
+        encoded_json = json.dumps(msg)
+        encoded_binary = dictionary.encode_update(nodes, seq=n)
+
+        t_json = _timeit(lambda: json.dumps(msg), args.repeat)
+        t_binary = _timeit(lambda: dictionary.encode_update(nodes, n), args.repeat)
+        t_json_decode = _timeit(lambda: json.loads(encoded_json), args.repeat)
+        t_binary_decode = _timeit(
+            lambda: dictionary.decode_update(encoded_binary), args.repeat
+        )
+        print(
+            f"  {n:5d} topics  size json {len(encoded_json):7d} B"
+            f"  binary {len(encoded_binary):6d} B"
+            f"  encode {t_json * 1e6:8.1f} / {t_binary * 1e6:8.1f} us"
+            f"  decode {t_json_decode * 1e6:8.1f} / {t_binary_decode * 1e6:8.1f} us"
+        )
+
+
+def bench_persistence(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    config = synthetic_config(args.nodes)
+    state = State.from_config(config, logger)
+    topics = state.topics
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "state.bin"
+        snapshots = StateSnapshotFile(path, state, logger)
+        print(f"persistence benchmark, {args.nodes} nodes, {len(topics)} channels")
+
+        # every interval changes a few channels, like faders being moved
+        for _ in range(args.intervals):
+            for _ in range(args.updates):
+                state.process_updates(
+                    {"nodes": {random.choice(topics): random.randrange(1024)}}
+                )
+            _drain(state)
+            loop.run_until_complete(snapshots.write())
+
+        stats = snapshots.stats
+        changed_bytes = stats["changed_channels"] * state.store.values.itemsize
+        print(
+            f"  {stats['writes']} snapshots of {stats['bytes_written'] // stats['writes']} B"
+            f"  write amplification {stats['bytes_written'] / max(changed_bytes, 1):.1f}x"
+            f"  write + fsync {_timeit(lambda: loop.run_until_complete(snapshots.write()), 20) * 1e3:.2f} ms"
+        )
+
+        def cold_start():
+            cold = State.from_config(config, logger)
+            loop.run_until_complete(cold.init())
+            _drain(cold)
+
+        def warm_start():
+            warm = State.from_config(config, logger)
+            StateSnapshotFile(path, warm, logger).restore()
+            loop.run_until_complete(warm.init())
+            _drain(warm)
+
+        print(f"  startup without snapshot  {_timeit(cold_start, 10) * 1e3:8.2f} ms")
+        print(f"  startup with restore      {_timeit(warm_start, 10) * 1e3:8.2f} ms")
+
+
+def bench_history(args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    state = State.from_config(synthetic_config(args.nodes), logger)
+    topics = state.topics
+    values = itertools.count()
+    batches = [
+        {"nodes": {random.choice(topics): next(values) % 1024 for _ in range(10)}}
+        for _ in range(args.repeat)
+    ]
+
+    def process():
+        for batch in batches:
+            state.process_updates(batch)
+        _drain(state)
+
+    history = state.history
+    state.history = History(())
+    state.history.record = lambda updates: None
+    t_plain = _timeit(process, 5)
+    state.history = history
+    t_recording = _timeit(process, 5)
+    history._pending = history._pending[: args.repeat]
+    t_flush = _timeit(history.flush, 1)
+
+    print(f"history benchmark, {args.nodes} nodes, {len(topics)} topics")
+    print(
+        f"  process_updates of 10 topics  without history {t_plain / args.repeat * 1e6:6.1f} us"
+        f"  with history {t_recording / args.repeat * 1e6:6.1f} us"
+        f"  background flush {t_flush / args.repeat * 1e6:6.1f} us"
+    )
+
+    # fill the history up to its memory cap
+    for _ in range(args.fill):
+        state.process_updates(
+            {"nodes": {topic: next(values) % 1024 for topic in topics[:100]}}
+        )
+        _drain(state)
+        history.flush()
+    print(
+        f"  {state.history.stats['samples']} samples recorded,"
+        f" {state.history.memory() / 1024:.0f} KiB kept"
+    )
+    now = int(time.time() * 1000)
+    for bucket in (None, 60000):
+        t_query = _timeit(
+            lambda: state.history.query(topics[:100], now - 3600000, now, bucket), 5
+        )
+        print(f"  query 100 topics, bucket {bucket}: {t_query * 1e3:8.2f} ms")
+
+    # every topic filled up to max_samples, one change per second
+    full_topics = topics[: args.full_topics]
+    full = History(full_topics)
+    for i in range(16384):
+        full.record(
+            [StateUpdate(topic, i % 1024) for topic in full_topics],
+            now - (16384 - i) * 1000,
+        )
+    full.flush()
+    # only the copy of the samples runs on the event loop for a websocket query
+    t_copy = _timeit(lambda: full._copy(full_topics, 0, now), 5)
+    print(
+        f"  query {len(full_topics)} full topics, on the event loop {t_copy * 1e3:8.2f} ms"
+    )
+    for bucket in (None, 60000):
+        t_query = _timeit(lambda: full.query(full_topics, 0, now, bucket), 5)
+        print(
+            f"  query {len(full_topics)} full topics, bucket {bucket}:"
+            f" {t_query * 1e3:8.2f} ms"
+        )
+
+
+class _BrokerStandIn:
+    """
+    Records when messages are published, every publish blocks for a random latency
+    like a paho publish on a busy connection.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.published = []
+
+    def publish(self, topic, value):
+        self.published.append(time.monotonic())
+        time.sleep(random.uniform(0, self.latency))
+
+
+def _lateness(published, start, schedule):
+    lateness = [t - start - at for t, at in zip(published, schedule)]
+    ordered = sorted(lateness)
+    return (
+        f"mean {sum(lateness) / len(lateness) * 1e3:7.2f} ms"
+        f"  p99 {ordered[int(len(ordered) * 0.99)] * 1e3:7.2f} ms"
+        f"  max {ordered[-1] * 1e3:7.2f} ms"
+        f"  last event {lateness[-1] * 1e3:7.2f} ms"
+    )
+
+
+def bench_effects(args):
+    effect = EFFECTS[args.effect]
+    # effects with variants are measured with their first one
+    effect = effect.get("variants", [effect])[0]
+    events = compile_timeline(effect)
+    # the sleep loop published every topic on its own, the engine sends every set and
+    # every fade of a step as one bulk update
+    legacy_schedule = [
+        at / args.tempo
+        for at, step in events
+        for _ in [*step.get("set", {}), *step.get("fade", {})]
+    ]
+    schedule = [
+        at / args.tempo for at, step in events for key in ("set", "fade") if key in step
+    ]
+    gaps = [
+        (later - at) / args.tempo
+        for (at, _), (later, _) in zip(events, events[1:] + events[-1:])
+    ]
+    print(
+        f"effect timing benchmark, {args.effect} at tempo {args.tempo},"
+        f" {len(legacy_schedule)} single / {len(schedule)} bulk publishes,"
+        f" broker latency up to {args.latency * 1e3:.1f} ms"
+    )
+
+    # the previous implementation, sleeping between the publishes
+    broker = _BrokerStandIn(args.latency)
+    start = time.monotonic()
+    for (at, step), gap in zip(events, gaps):
+        for topic, value in [
+            *step.get("set", {}).items(),
+            *step.get("fade", {}).items(),
+        ]:
+            broker.publish(topic, value)
+        time.sleep(gap)
+    print(f"  sleep loop  {_lateness(broker.published, start, legacy_schedule)}")
+
+    broker = _BrokerStandIn(args.latency)
+    engine = EffectEngine({args.effect: effect}, broker.publish, lambda s: None, logger)
+
+    async def play():
+        engine.play(args.effect, args.tempo)
+        await engine._running[args.effect].task
+
+    loop = asyncio.new_event_loop()
+    start = time.monotonic()
+    loop.run_until_complete(play())
+    print(f"  timeline    {_lateness(broker.published, start, schedule)}")
+
+
+async def _consume_updates(state: State):
+    # stands in for the websocket broadcast and the mqtt publisher
+    async def websocket():
+        while True:
+            await state.ws_update_queue.get()
+            state.ws_update_queue.drain()
+
+    async def mqtt():
+        while True:
+            await state.mqtt_update_queue.get()
+
+    await asyncio.gather(websocket(), mqtt())
+
+
+async def _ingest(state: State, rate: int, duration: float, batched: bool):
+    """
+    Publish random channel writes at rate messages per second for duration seconds
+
+    :returns: cpu time, messages and catch-up time after the last message
+    """
+    batcher = MessageBatcher(state, logger)
+    broker: asyncio.Queue = asyncio.Queue()
+
+    async def legacy():
+        while True:
+            topic, payload = await broker.get()
+            # hbmqtt hands every message over through its own task
+            await asyncio.sleep(0)
+            batcher.handle_messages([(topic, payload)])
+
+    def deliver(topic: str, payload: bytes):
+        if batched:
+            batcher.put_nowait(topic, payload)
+        else:
+            broker.put_nowait((topic, payload))
+
+    tasks = [
+        asyncio.ensure_future(coro)
+        for coro in (
+            batcher.run() if batched else legacy(),
+            state.frames.run(),
+            _consume_updates(state),
+        )
+    ]
+
+    topics = [
+        f"/bench/{room}/{i}/{channel}"
+        for i, room in ((i, i // 10) for i in range(len(state.nodes)))
+        for channel in CHANNELS
+    ]
+    loop = asyncio.get_event_loop()
+    cpu = time.process_time()
+    start = loop.time()
+    sent = 0
+    # messages arrive in bursts of one millisecond
+    for tick in range(int(duration * 1000)):
+        for _ in range(rate * (tick + 1) // 1000 - sent):
+            deliver(random.choice(topics), str(random.randrange(1024)).encode())
+            sent += 1
+        await asyncio.sleep(max(start + (tick + 1) / 1000 - loop.time(), 0))
+
+    sent_at = loop.time()
+    while not (batcher._queue.empty() and broker.empty()):
+        await asyncio.sleep(0.001)
+    catch_up = loop.time() - sent_at
+    cpu = time.process_time() - cpu
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return cpu, sent, catch_up, batcher.stats
+
+
+def bench_ingest(args):
+    print(
+        f"mqtt ingestion benchmark, {args.nodes} nodes,"
+        f" {args.duration:.0f} s per run, frame rate {args.frame_rate}/s"
+    )
+    for rate in args.rates:
+        for batched in (False, True):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            config = synthetic_config(args.nodes)
+            config["mqtt"]["max_frame_rate"] = args.frame_rate
+            state = State.from_config(config, logger)
+            cpu, sent, catch_up, stats = loop.run_until_complete(
+                _ingest(state, rate, args.duration, batched)
+            )
+            loop.close()
+            print(
+                f"  {rate:6d} msg/s {'batched' if batched else 'single ':8s}"
+                f" cpu {cpu / args.duration * 100:5.1f} %"
+                f"  {cpu / sent * 1e6:6.1f} us/msg"
+                f"  state passes {stats['state_updates']:6d}"
+                f"  frames {state.frames.stats['frames']:6d}"
+                f"  catch-up {catch_up * 1e3:7.1f} ms"
+            )
+
+    # a script setting several channels, as separate messages or one bulk update
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state = State.from_config(synthetic_config(args.nodes), logger)
+    batcher = MessageBatcher(state, logger)
+    topics = [f"/bench/0/{i}/{channel}" for i in range(10) for channel in CHANNELS]
+    topics = topics[: args.channels]
+    values = itertools.count()
+
+    def single():
+        return [(topic, str(next(values) % 1024).encode()) for topic in topics]
+
+    def bulk():
+        nodes = {topic: next(values) % 1024 for topic in topics}
+        return [("/haspa/state/set", json.dumps({"nodes": nodes}).encode())]
+
+    for name, messages in (("single messages", single), ("bulk update", bulk)):
+
+        def ingest():
+            batcher.handle_messages(messages())
+            _drain(state)
+
+        print(
+            f"  {args.channels} channels as {name:16s}"
+            f" {len(messages()):3d} messages"
+            f"  {min(_timeit(ingest, 200) for _ in range(5)) * 1e6:8.1f} us"
+        )
+    loop.close()
+
+
+def _subscribe_size(topics) -> int:
+    # SUBSCRIBE payload, length prefixed topic and requested qos per subscription
+    return sum(len(topic.encode()) + 3 for topic in topics)
+
+
+def bench_topics(args):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    config = synthetic_config(args.nodes)
+    state = State.from_config(config, logger)
+
+    # the previous subscription list, every translation key and target and every
+    # node mapping, duplicates included
+    legacy = [
+        topic
+        for mapping, targets in config["translation"].items()
+        for topic in [mapping, *targets]
+    ]
+    legacy.extend(topic for node in state.nodes for topic in node.mappings)
+    filters = covering_filters(
+        state.get_mqtt_topics(), exclude={node.topic for node in state.nodes}
+    )
+    print(f"topic subscription benchmark, {args.nodes} nodes")
+    print(
+        f"  subscriptions  per topic {len(legacy):6d} ({_subscribe_size(legacy):7d} B)"
+        f"  wildcards {len(filters):3d} ({_subscribe_size(filters)} B)"
+    )
+
+    # a wildcard translation per room and channel on top of the synthetic config,
+    # e.g. /bench/3/+/w for all w channels of room 3
+    rooms = (args.nodes + 9) // 10
+    wildcards = {
+        f"/bench/{room}/+/{channel}": [f"/bench/{room}/{channel}"]
+        for room in range(rooms)
+        for channel in CHANNELS
+    }
+    translation = Translation(
+        {**config["translation"], **wildcards}, base_topics=state.get_mqtt_topics()
+    )
+    trie = TopicTrie()
+    for topic_filter, targets in wildcards.items():
+        trie.add(topic_filter, targets)
+    topics = [
+        f"/bench/{random.randrange(rooms)}/x{i}/{random.choice(CHANNELS)}"
+        for i in range(args.repeat)
+    ]
+
+    def linear():
+        for topic in topics:
+            [t for f, t in wildcards.items() if matches(f, topic)]
+
+    def trie_match():
+        for topic in topics:
+            trie.match(topic)
+
+    def translate():
+        translation._wildcard_cache.clear()
+        for topic in topics:
+            translation.translate(topic)
+
+    def translate_cached():
+        for topic in topics:
+            translation.translate(topic)
+
+    print(f"  matching against {len(wildcards)} wildcard translations")
+    for name, func in (
+        ("linear scan", linear),
+        ("topic trie", trie_match),
+        ("translate", translate),
+        ("translate cached", translate_cached),
+    ):
+        print(f"  {name:20s} {_timeit(func, 5) / len(topics) * 1e6:8.2f} us/topic")
+
+
+class _AckingBroker:
+    """
+    Acknowledges every publish after a random round trip, qos 1 and 2 publishes are
+    lost with the given probability and never acknowledged.
+    """
+
+    def __init__(self, rtt: float, loss: float):
+        self.rtt = rtt
+        self.loss = loss
+        self.received = 0
+
+    async def publish(self, topic: str, payload: bytes, qos: int, retain: bool):
+        if qos and random.random() < self.loss:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.rtt)
+        self.received += 1
+
+
+async def _publish_rounds(state: State, broker: _AckingBroker, args, window: int):
+    """
+    Change every channel and send the resulting frames, args.rounds times
+
+    :returns: elapsed time and the publisher, None for the serial loop
+    """
+    loop = asyncio.get_event_loop()
+    publisher = None
+    if window:
+        publisher = Publisher(
+            state.mqtt_update_queue,
+            broker.publish,
+            logger,
+            window=window,
+            ack_timeout=args.rtt * 10,
+            retry_delay=args.rtt,
+        )
+        task = asyncio.ensure_future(publisher.run())
+
+    start = loop.time()
+    for value in range(args.rounds):
+        state.process_updates({"nodes": {"/bench": value}})
+        state.frames.flush(loop.time())
+        if publisher is None:
+            # the previous loop, one publish after the other
+            while not state.mqtt_update_queue.empty():
+                msg = FrameCoalescer.render(state.mqtt_update_queue.get_nowait())
+                await broker.publish(msg.topic, str(msg.payload).encode(), 0, False)
+        else:
+            while not publisher.idle():
+                await asyncio.sleep(args.rtt / 10)
+    elapsed = loop.time() - start
+
+    if publisher is not None:
+        task.cancel()
+    return elapsed, publisher
+
+
+def bench_publish(args):
+    config = synthetic_config(args.nodes)
+    # one topic per room of ten nodes, a frame per room and round
+    for i, node in enumerate(config["nodes"]):
+        node["topic"] = f"/bench/led/{i // 10}"
+        node["qos"] = args.qos
+    frames = (args.nodes + 9) // 10 * args.rounds
+    print(
+        f"mqtt publish benchmark, {frames} frames, qos {args.qos},"
+        f" round trip {args.rtt * 1e3:.1f} ms, {args.loss * 100:.1f} % lost"
+    )
+
+    for window in [0, *args.windows]:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        state = State.from_config(config, logger)
+        broker = _AckingBroker(args.rtt, args.loss if window else 0)
+        elapsed, publisher = loop.run_until_complete(
+            _publish_rounds(state, broker, args, window)
+        )
+        name = f"window {window}" if window else "serial loop"
+        line = f"  {name:12s} {elapsed * 1e3:8.1f} ms  {frames / elapsed:8.0f} frames/s"
+        if publisher is not None:
+            stats = publisher.stats
+            line += (
+                f"  latency {publisher.to_dict()['mean_latency_ms']:5.2f} ms"
+                f"  retries {stats['retries']:4d}  failed {stats['failed']:3d}"
+            )
+        print(line)
+        loop.close()
+
+
+_MODULE_PROCESS = """
+import sys, time
+start = time.perf_counter()
+sys.argv = ["benchmark", "--config-dir", {config_dir!r}]
+{setup}
+rss = [l for l in open("/proc/self/status") if l.startswith("VmRSS")][0].split()[1]
+print(time.perf_counter() - start, int(rss) * 1024)
+"""
+
+_STANDALONE = """
+import importlib
+from hauptbahnhof.host import MODULES
+path, name = MODULES[{module!r}].split(":")
+getattr(importlib.import_module(path), name)().start()
+"""
+
+_HOSTED = """
+import logging
+from hauptbahnhof.core.config import Config
+from hauptbahnhof.host import ModuleHost
+config = Config.from_file({config_dir!r} + "/hauptbahnhof.json")
+host = ModuleHost({config_dir!r}, config, {modules!r}, logging.getLogger("host"))
+for module in {modules!r}:
+    host.start_module(module)
+"""
+
+
+def _run_module_process(setup: str, config_dir: str):
+    code = _MODULE_PROCESS.format(config_dir=config_dir, setup=setup)
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).resolve().parent.parent,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    # interpreter start and imports count as well
+    return time.perf_counter() - start, int(output[1])
+
+
+def bench_host(args):
+    print(f"module host benchmark, modules {', '.join(args.modules)}")
+    separate_time = separate_rss = 0
+    for module in args.modules:
+        setup = _STANDALONE.format(module=module)
+        elapsed, rss = _run_module_process(setup, args.config_dir)
+        separate_time += elapsed
+        separate_rss += rss
+        print(f"  {module:24s} {elapsed * 1e3:8.1f} ms  {rss / 2**20:6.1f} MiB")
+    print(
+        f"  {'separate processes':24s} {separate_time * 1e3:8.1f} ms"
+        f"  {separate_rss / 2**20:6.1f} MiB"
+    )
+
+    setup = _HOSTED.format(config_dir=args.config_dir, modules=args.modules)
+    elapsed, rss = _run_module_process(setup, args.config_dir)
+    print(f"  {'host':24s} {elapsed * 1e3:8.1f} ms  {rss / 2**20:6.1f} MiB")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser("hauptbahnhof core benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    routing = subparsers.add_parser(
+        "routing", help="topic routing in State.process_updates"
+    )
+    routing.add_argument("--nodes", type=int, default=500)
+    routing.add_argument("--repeat", type=int, default=200)
+    routing.set_defaults(func=bench_routing)
+
+    store = subparsers.add_parser("store", help="channel store memory and throughput")
+    store.add_argument("--nodes", type=int, default=1000)
+    store.add_argument("--repeat", type=int, default=200)
+    store.set_defaults(func=bench_store)
+
+    protocol = subparsers.add_parser(
+        "protocol", help="json against binary websocket state updates"
+    )
+    protocol.add_argument("--nodes", type=int, default=500)
+    protocol.add_argument("--repeat", type=int, default=200)
+    protocol.set_defaults(func=bench_protocol)
+
+    persistence = subparsers.add_parser(
+        "persistence", help="state snapshot writes and warm start"
+    )
+    persistence.add_argument("--nodes", type=int, default=500)
+    persistence.add_argument("--intervals", type=int, default=50)
+    persistence.add_argument("--updates", type=int, default=20)
+    persistence.set_defaults(func=bench_persistence)
+
+    history = subparsers.add_parser("history", help="recording and querying history")
+    history.add_argument("--nodes", type=int, default=500)
+    history.add_argument("--repeat", type=int, default=2000)
+    history.add_argument("--fill", type=int, default=20000)
+    history.add_argument("--full-topics", type=int, default=33)
+    history.set_defaults(func=bench_history)
+
+    effects = subparsers.add_parser(
+        "effects", help="timing jitter of hackerman effects"
+    )
+    effects.add_argument("--effect", default="strobo", choices=sorted(EFFECTS))
+    effects.add_argument("--tempo", type=float, default=2)
+    effects.add_argument("--latency", type=float, default=0.005)
+    effects.set_defaults(func=bench_effects)
+
+    ingest = subparsers.add_parser(
+        "ingest", help="batched mqtt ingestion against one message at a time"
+    )
+    ingest.add_argument("--nodes", type=int, default=500)
+    ingest.add_argument("--rates", type=int, nargs="+", default=[1000, 10000])
+    ingest.add_argument("--duration", type=float, default=2)
+    ingest.add_argument("--frame-rate", type=float, default=50)
+    ingest.add_argument("--channels", type=int, default=30)
+    ingest.set_defaults(func=bench_ingest)
+
+    topics = subparsers.add_parser(
+        "topics", help="wildcard subscriptions and topic matching"
+    )
+    topics.add_argument("--nodes", type=int, default=500)
+    topics.add_argument("--repeat", type=int, default=2000)
+    topics.set_defaults(func=bench_topics)
+
+    publish = subparsers.add_parser(
+        "publish", help="pipelined mqtt publishing against the serial loop"
+    )
+    publish.add_argument("--nodes", type=int, default=500)
+    publish.add_argument("--rounds", type=int, default=20)
+    publish.add_argument("--windows", type=int, nargs="+", default=[1, 4, 16, 64])
+    publish.add_argument("--rtt", type=float, default=0.002)
+    publish.add_argument("--qos", type=int, default=1, choices=(0, 1, 2))
+    publish.add_argument("--loss", type=float, default=0.01)
+    publish.set_defaults(func=bench_publish)
+
+    host = subparsers.add_parser(
+        "host", help="startup time and memory of the module host"
+    )
+    host.add_argument("--config-dir", default="conf")
+    host.add_argument(
+        "--modules", nargs="+", default=["hackerman", "nsa", "mpd", "haspa_web"]
+    )
+    host.set_defaults(func=bench_host)
+
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()